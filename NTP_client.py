@@ -11,50 +11,60 @@
 import socket
 import struct
 import select
-from utime import gmtime
+import uasyncio as asyncio
+from utime import gmtime, ticks_us, ticks_ms, ticks_diff, ticks_add
+from random import getrandbits
 from machine import RTC
+from lib_pico.NTP_protocol import *
+from lib_pico.local_clock import local_clock
 
 HOST_DOMAIN = const("fr.pool.ntp.org")
-CLIENT_MODE = const(3)
-SERVER_MODE = const(4)
-SNTP_VERSION = const(4)
-CLOCK_OUT_OF_SYNC = const(3)
-DGRAM_SIZE = const(48)
 SERVER_REPLY_TIMOUT = const(1) # in seconds
+INTERLEAVED_FALLBACK = const(3) # basic replies in a row before giving up interleaved requests
+NONCE_BITS = const(12) # random low bits of the transmit timestamp fraction, 2**12 * 2**-32 s < 1 us
+
+# reasons for dropping a datagram before decoding it
+DROP_LENGTH = const(0)
+DROP_MODE = const(1)
+DROP_ZERO_TRANSMIT = const(2)
+DROP_ORIGIN = const(3)
+DROP_REASONS = ("length", "mode", "zero transmit", "origin")
 
-# (date(2000, 1, 1) - date(1900, 1, 1)).days * 24*60*60
-# (date(1970, 1, 1) - date(1900, 1, 1)).days * 24*60*60
-TIME_STAMP_UNIX = const(2208988800) # first day for UNIX epoch 1970-01-01 00:00
-TIME_STAMP_2000 = const(3155673600)
 NTP_DELTA = TIME_STAMP_2000 if gmtime(0)[0] == 2000 else TIME_STAMP_UNIX
 
 
+def local_ntp_timestamp():
+    """ returns local time as NTP timestamp (seconds since 1900, 32 bits fraction).
+    The RTC only gives seconds, the fraction comes from ticks_us(), see local_clock.py"""
+    sec, us = divmod(local_clock.time_us(), 10**6)
+    return sec + NTP_DELTA, (us << 32) // 10**6
+
+
+def _ntp_time(frame, hrs_offset):
+    # RTC corrected by the measured offset, rounded to the second
+    sec, frac = local_ntp_timestamp()
+    val = sec + (frame.offset_us + 500000) // 10**6
+    return (max(val - NTP_DELTA + hrs_offset * 3600, 0), frame, _ntp_client.server)
+
+
+def get_ntp_time(hrs_offset=0, capture=None):  # Local time offset in hrs relative to UTC
+    frame = _ntp_client.poll(capture)
+    if frame is None:
+        return 0  # Timeout or LAN error occurred
+    return _ntp_time(frame, hrs_offset)
 
 
-def get_ntp_time(hrs_offset=0):  # Local time offset in hrs relative to UTC
-    NTP_QUERY = bytearray(DGRAM_SIZE)
-    NTP_QUERY[0] = (SNTP_VERSION << 3 ) | CLIENT_MODE
-    try:
-        addr = socket.getaddrinfo(HOST_DOMAIN, 123)[0][-1]
-        ntp_server = NTPserver(HOST_DOMAIN)
-        ntp_server.ip_address , ntp_server.ip_port = addr
-    except OSError:
+def shift_local_time(us):
+    """ to be called when the local clock (RTC) is stepped by us microseconds"""
+    _ntp_client.shift_local(us)
+
+
+async def async_get_ntp_time(hrs_offset=0, capture=None):
+    """ same as get_ntp_time(), without blocking the event loop while waiting for the reply"""
+    frame = await _ntp_client.async_poll(capture)
+    if frame is None:
         return 0
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    poller = select.poll()
-    poller.register(s, select.POLLIN)
-    try:
-        s.sendto(NTP_QUERY, addr)
-        if poller.poll(1000):  # time in milliseconds
-            msg = s.recv(48)
-            frame = NTPframe(msg)
-            val = struct.unpack("!I", msg[40:44])[0]  # Can return 0
-            return (max(val - NTP_DELTA + hrs_offset * 3600, 0),frame, ntp_server)
-    except OSError:
-        pass  # LAN error
-    finally:
-        s.close()
-    return 0  # Timeout or LAN error occurred
+    return _ntp_time(frame, hrs_offset)
 
 
 # There's currently no timezone support in MicroPython, and the RTC is set in UTC time.
@@ -96,11 +106,281 @@ class NTPserver():
         return s
 
 
+class NTPclient():
+    """ client side of the NTP exchange, kept across polls.
+    In interleaved mode (draft-ietf-ntp-interleaved-modes, as implemented by chrony)
+    the request carries the server receive timestamp and the local receive timestamp of
+    the previous reply. A server supporting it answers with the precise transmit timestamp
+    of its previous reply, and the offset is computed on the previous exchange:
+        T1 = previous local transmit, T2 = previous server receive,
+        T3 = transmit timestamp of this reply, T4 = previous local receive.
+    The reply origin timestamp tells which mode the server used : our transmit timestamp
+    in basic mode, our previous receive timestamp in interleaved mode.
+    After INTERLEAVED_FALLBACK basic replies in a row, requests are sent in basic mode."""
+    def __init__(self, host=HOST_DOMAIN, interleaved=True):
+        self.server = NTPserver(host)
+        self.interleaved = interleaved
+        self._addr = None
+        self._query = bytearray(DGRAM_SIZE)
+        self._query[0] = (SNTP_VERSION << 3 ) | CLIENT_MODE
+        self._reply = bytearray(DGRAM_SIZE)
+        # previous exchange, NTP timestamps (sec, frac)
+        self._prev_tx = None         # local transmit T1
+        self._prev_server_rx = None  # server receive T2
+        self._prev_rx = None         # local receive T4
+        self._basic_in_a_row = 0
+        self._local_shift_us = 0     # total of the local clock steps, see shift_local()
+        self._capture = None         # capture of the last exchange, records the steps too
+        self._in_flight = False
+        self.interleaved_replies = 0
+        self.basic_replies = 0
+        self.drops = [0] * len(DROP_REASONS)
+        self.timeouts = 0
+
+    def shift_local(self, us):
+        """ the local clock has been stepped by us. Interleaved mode computes the offset
+        from the local stamps of the previous exchange: they are moved to the new time
+        scale, and so are those of an exchange in progress, see _decode()"""
+        self._local_shift_us += us
+        if not self._in_flight and self._capture is not None:
+            self._capture.append_step(us, False)
+        if self._prev_tx is not None:
+            self._prev_tx = ts_add_us(self._prev_tx[0], self._prev_tx[1], us)
+            self._prev_rx = ts_add_us(self._prev_rx[0], self._prev_rx[1], us)
+
+    def _resolve(self):
+        if self._addr is None:
+            # keep the same server across polls : interleaved mode needs the previous exchange
+            self._addr = socket.getaddrinfo(self.server.host, 123)[0][-1]
+            self.server.ip_address , self.server.ip_port = self._addr
+        return self._addr
+
+    def _build_query(self, t1):
+        q = self._query
+        use_interleaved = (self.interleaved and self._prev_rx is not None
+                           and self._basic_in_a_row < INTERLEAVED_FALLBACK)
+        if use_interleaved:
+            struct.pack_into("!IIII", q, ORIGIN_OFFSET, self._prev_server_rx[0], self._prev_server_rx[1],
+                             self._prev_rx[0], self._prev_rx[1])
+        else:
+            struct.pack_into("!IIII", q, ORIGIN_OFFSET, 0, 0, 0, 0)
+        struct.pack_into("!II", q, TRANSMIT_OFFSET, t1[0], t1[1])
+        return use_interleaved
+
+    def check_reply(self, n, use_interleaved):
+        """ fast check of the received datagram, before any decoding or allocation.
+        Returns None if the datagram answers our request, or the drop reason."""
+        r = self._reply
+        q = self._query
+        if n != DGRAM_SIZE:
+            return DROP_LENGTH
+        if r[0] & 7 != SERVER_MODE:
+            return DROP_MODE
+        zero = True
+        for i in range(TRANSMIT_OFFSET, DGRAM_SIZE):
+            if r[i]:
+                zero = False
+                break
+        if zero:
+            return DROP_ZERO_TRANSMIT
+        # origin must echo our transmit timestamp (the nonce), or in interleaved mode our previous receive timestamp
+        basic = True
+        for i in range(8):
+            if r[ORIGIN_OFFSET + i] != q[TRANSMIT_OFFSET + i]:
+                basic = False
+                break
+        if basic:
+            return None
+        if use_interleaved:
+            for i in range(8):
+                if r[ORIGIN_OFFSET + i] != q[RECEIVE_OFFSET + i]:
+                    return DROP_ORIGIN
+            return None
+        return DROP_ORIGIN
+
+    def _send(self, capture):
+        """ opens a socket connected to the server and sends the query.
+        Returns (socket, poller, t1, use_interleaved, send_ticks, local shift), None on LAN error.
+        The socket is connected so that datagrams from other addresses are dropped by the network stack."""
+        try:
+            addr = self._resolve()
+        except OSError:
+            return None
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        poller = select.poll()
+        poller.register(s, select.POLLIN)
+        try:
+            s.connect(addr)
+            t1_sec, t1_frac = local_ntp_timestamp()
+            t1 = (t1_sec, (t1_frac & ~((1 << NONCE_BITS) - 1)) | getrandbits(NONCE_BITS))
+            use_interleaved = self._build_query(t1)
+            send_ticks = ticks_us()
+            s.send(self._query)
+        except OSError:
+            s.close()
+            self._addr = None  # LAN error, resolve again next time
+            return None
+        self._capture = capture
+        self._in_flight = True
+        return s, poller, t1, use_interleaved, send_ticks, self._local_shift_us
+
+    def _read(self, s, use_interleaved):
+        """ reads one datagram, returns its receive ticks if it is our reply, None if dropped"""
+        n = s.readinto(self._reply)
+        recv_ticks = ticks_us()
+        reason = self.check_reply(n, use_interleaved)
+        if reason is None:
+            return recv_ticks
+        self.drops[reason] += 1
+        return None
+
+    def poll(self, capture=None):
+        """ one exchange, returns the NTPframe with offset and delay set, None on failure.
+        Datagrams failing check_reply() are counted in self.drops and the wait goes on
+        until a valid reply or the timeout. Blocks up to SERVER_REPLY_TIMOUT, see async_poll()."""
+        if not local_clock.is_anchored():
+            local_clock.anchor()
+        exchange = self._send(capture)
+        if exchange is None:
+            return None
+        s, poller, t1, use_interleaved, send_ticks, shift_us = exchange
+        deadline = ticks_add(ticks_ms(), SERVER_REPLY_TIMOUT * 1000)
+        try:
+            while True:
+                remaining = ticks_diff(deadline, ticks_ms())
+                if remaining <= 0 or not poller.poll(remaining):
+                    self.timeouts += 1
+                    return self._failed(capture, shift_us)
+                recv_ticks = self._read(s, use_interleaved)
+                if recv_ticks is not None:
+                    break
+        except OSError:
+            self._addr = None
+            return self._failed(capture, shift_us)
+        finally:
+            s.close()
+        return self._decode(capture, t1, use_interleaved, send_ticks, recv_ticks, shift_us)
+
+    async def async_poll(self, capture=None):
+        """ same as poll(), but yields to the other tasks while waiting for the reply.
+        The receive stamp is taken when this task is scheduled again: the scheduling
+        latency shows in the measured delay, hence in the error estimate."""
+        if not local_clock.is_anchored():
+            await local_clock.async_anchor()
+        exchange = self._send(capture)
+        if exchange is None:
+            return None
+        s, poller, t1, use_interleaved, send_ticks, shift_us = exchange
+        deadline = ticks_add(ticks_ms(), SERVER_REPLY_TIMOUT * 1000)
+        try:
+            while True:
+                if poller.poll(0):
+                    recv_ticks = self._read(s, use_interleaved)
+                    if recv_ticks is not None:
+                        break
+                elif ticks_diff(deadline, ticks_ms()) <= 0:
+                    self.timeouts += 1
+                    return self._failed(capture, shift_us)
+                else:
+                    await asyncio.sleep_ms(0)
+        except OSError:
+            self._addr = None
+            return self._failed(capture, shift_us)
+        finally:
+            s.close()
+        return self._decode(capture, t1, use_interleaved, send_ticks, recv_ticks, shift_us)
+
+    def _failed(self, capture, shift_us):
+        """ no reply : the local clock steps seen during the exchange only moved the previous one"""
+        self._in_flight = False
+        step_us = self._local_shift_us - shift_us
+        if step_us and capture is not None:
+            capture.append_step(step_us, False)
+        return None
+
+    def _decode(self, capture, t1, use_interleaved, send_ticks, recv_ticks, shift_us):
+        self._in_flight = False
+        msg = bytes(self._reply)
+        step_us = self._local_shift_us - shift_us
+        if capture is not None:
+            if step_us:
+                capture.append_step(step_us, True)
+            capture.append(msg, t1[0], t1[1], send_ticks, recv_ticks)
+        t4 = ts_add_us(t1[0], t1[1], ticks_diff(recv_ticks, send_ticks))
+        frame = NTPframe(msg)
+        origin = decode_timestamps(msg)[0]
+        basic = origin == t1
+        if step_us:
+            # local clock stepped during the exchange, T1 and T4 moved to the new time scale
+            t1 = ts_add_us(t1[0], t1[1], step_us)
+            t4 = ts_add_us(t4[0], t4[1], step_us)
+        if basic:
+            frame.set_exchange(t1, frame._T2, frame._T3, t4)
+            self.basic_replies += 1
+            if use_interleaved:
+                self._basic_in_a_row += 1
+        else:  # origin == previous local receive, checked by check_reply()
+            frame.set_exchange(self._prev_tx, self._prev_server_rx, frame._T3, self._prev_rx)
+            frame.interleaved = True
+            self.interleaved_replies += 1
+            self._basic_in_a_row = 0
+        self._prev_tx = t1
+        self._prev_server_rx = frame._T2
+        self._prev_rx = t4
+        return frame
+
+    def repr_drops(self):
+        s = f"timeouts: {self.timeouts}"
+        for i in range(len(DROP_REASONS)):
+            s += f" | {DROP_REASONS[i]}: {self.drops[i]}"
+        return s
+
+    def __repr__(self):
+        mode = "interleaved" if self.interleaved and self._basic_in_a_row < INTERLEAVED_FALLBACK else "basic"
+        s = f"NTP client ({mode}): interleaved replies {self.interleaved_replies} | basic replies {self.basic_replies}"
+        s += f"\n\t{self.repr_drops()}"
+        return s
+
+
+_ntp_client = NTPclient()
+
+
+class NTPcapture():
+    """ appends raw server replies and their local stamps to a fixed-record binary file,
+    and the local clock steps. Records are CAPTURE_RECORD_SIZE bytes long, see NTP_replay.py to decode them."""
+    def __init__(self, filename="ntp_capture.bin"):
+        self.filename = filename
+        self._record = bytearray(CAPTURE_RECORD_SIZE)
+        self.count = 0
+
+    def append(self, msg, t1_sec, t1_frac, send_ticks, recv_ticks):
+        if len(msg) != DGRAM_SIZE:
+            return
+        struct.pack_into(CAPTURE_HEADER_FORMAT, self._record, 0, t1_sec, t1_frac, send_ticks, recv_ticks)
+        self._record[CAPTURE_HEADER_SIZE:] = msg
+        self._write()
+
+    def append_step(self, us, in_flight):
+        """ records a local clock step, for the replay to move its previous exchange stamps"""
+        struct.pack_into(CAPTURE_HEADER_FORMAT, self._record, 0, CAPTURE_STEP_MARKER,
+                         CAPTURE_STEP_IN_FLIGHT if in_flight else 0, 0, 0)
+        self._record[CAPTURE_HEADER_SIZE:] = bytes(DGRAM_SIZE)
+        struct.pack_into(CAPTURE_STEP_FORMAT, self._record, CAPTURE_HEADER_SIZE, us)
+        self._write()
+
+    def _write(self):
+        with open(self.filename, "ab") as f:
+            f.write(self._record)
+        self.count += 1
+
+    def __repr__(self):
+        return f"NTP capture: {self.filename} ({self.count} records)"
+
+
 class NTPframe():
     def __init__(self, msg):
         self.is_valid = True
-        self.Leap_Indicator = (msg[0] & 0xC0) >> 6
-        self.mode  = msg[0] & 7
+        self.Leap_Indicator, self.mode = decode_mode(msg)
         if (self.Leap_Indicator == CLOCK_OUT_OF_SYNC) or (self.mode != SERVER_MODE) :
             self.is_valid = False
         self.version = (msg[0] & 0x38) >> 3
@@ -123,6 +403,14 @@ class NTPframe():
         self.T2_receive_timestamp =  convert_ts_to_ticks(msg[32:40])
         self.T3_transmit_timestamp = convert_ts_to_ticks(msg[40:48])
         self.gmt = convert_ts_to_time(msg[40:48])
+        _, self._T2, self._T3 = decode_timestamps(msg)
+        self.offset_us = 0
+        self.delay_us = 0
+        self.interleaved = False
+
+    def set_exchange(self, t1, t2, t3, t4):
+        """ computes offset and delay (RFC 4330) from the four (sec, frac) timestamps"""
+        self.offset_us, self.delay_us = offset_delay_us(t1, t2, t3, t4)
     
     def __repr__(self):
         s = "NTP frame:\n"
@@ -132,6 +420,7 @@ class NTPframe():
         s += (f"\n\t{self.ref_identifier}")
         s += (f"\n\tRef TimeStamp:      {repr_gmtime(self.ref_time)}")
         s += (f"\n\tTransmit TimeStamp: {repr_gmtime(self.gmt)}")
+        s += (f"\n\tOffset: {self.offset_us} us | Delay: {self.delay_us} us | {'interleaved' if self.interleaved else 'basic'}")
         return s
                 
         
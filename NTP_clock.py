@@ -1,13 +1,28 @@
-import hardware_setup
-from gui.core.ugui import Screen, ssd
-from gui.widgets import Label, LED, Dial, Pointer, Button, Textbox
-from gui.core.writer import CWriter
-# Font for CWriter
-import gui.fonts.arial10 as arial10
-import gui.fonts.arial35 as hours_font
-import gui.fonts.freesans20 as seconds_font
-import gui.fonts.freesans20 as date_font
-from gui.core.colors import *
+# staged startup : the clock is drawn from the RTC first,
+# DHT and NTP synchronisation are started in background once the first frame is shown
+from lib_pico.boot_stages import BootStages
+boot = BootStages()
+with boot.stage("display"):
+    import hardware_setup
+    from gui.core.ugui import Screen, ssd
+    from gui.widgets import Label, LED, Dial, Pointer, Button, Textbox
+    from lib_pico.screen_cache import CachedScreen, get_writer
+    from lib_pico.glyph_cache import GlyphLabel, get_glyph_cache
+    from lib_pico.dirty_regions import DirtyRegions
+    from gui.core.colors import *
+
+# Font for CWriter, loaded when the first screen is built
+arial10 = hours_font = seconds_font = date_font = None
+
+def load_fonts():
+    global arial10, hours_font, seconds_font, date_font
+    if arial10 is not None:
+        return
+    with boot.stage("fonts"):
+        import gui.fonts.arial10 as arial10
+        import gui.fonts.arial35 as hours_font
+        import gui.fonts.freesans20 as seconds_font
+        import gui.fonts.freesans20 as date_font
 #------------------------------------------------------------------------------
 # Now import other modules
 from cmath import rect, pi
@@ -17,12 +32,12 @@ import time
 #------------------------------------------------------------------------------
 # DEBUG logic analyser probe definitions
 from debug_utility.pulses import *
-    # D0 = Probe(27) # wifi_connect & async_wifi_connect | DHT11 pulses train
+    # D0 = Probe(27) # wifi_connect & async_wifi_connect
     # D1 = Probe(16) # wifi_connect>loop & async get_connection_status
     # D2 = Probe(17) # 
     # D3 = Probe(18) # NTP_clock_screen.aclock_screen
     # D4 = Probe(19) # 
-    # D5 = Probe(20) # 
+    # D5 = Probe(20) # DirtyRegions.flush
     # D6 = Probe(21) # 
     # D7 = Probe(26) # one_second_time_trigger
 
@@ -47,24 +62,44 @@ async def one_second_coroutine():
         await asyncio.timer_elapsed.wait()
         D7.on()
         asyncio.timer_elapsed.clear()
-#         dcf_clock.next_second()
-
-asyncio.create_task(one_second_coroutine())
+        ntp_device.next_second()
 
 #------------------------------------------------------------------------------
 # import ntp modules
-from NTP_clock.NTP_device import *
+with boot.stage("ntp device"):
+    from NTP_clock.NTP_device import *
 CET = const(1)
 ntp_device = NTP_device(time_zone=CET)
+# sites with a DCF77 receiver : ntp_device.add_source(DCF77source(dcf_clock))
 
 #------------------------------------------------------------------------------
-# import and setup temperature and humidity device
-from lib_pico.dht_v2 import DHT11device
+# temperature and humidity pipeline, the sensor is started by start_dht() in background
 DHT_PIN_IN = const(9)
 PERIOD = const(60)
-# active_clock = None
-dht11_device = DHT11device(DHT_PIN_IN, PERIOD)
-asyncio.create_task(dht11_device.async_measure())
+from lib_pico.dht_pipeline import DHTpipeline
+from lib_pico.text_log import TextLog, register_format
+dht_pipeline = DHTpipeline(PERIOD, clock=lambda: ntp_device.arbiter.now_ms() // 1000)
+
+#------------------------------------------------------------------------------
+# background startup stages, run once the first frame is displayed
+def start_dht():
+    import dht
+    from machine import Pin
+    dht_pipeline.start(dht.DHT11(Pin(DHT_PIN_IN)), asyncio.timer_elapsed)
+
+def start_ntp():
+    # only the kickoff is timed by run_stages, the first NTP sample is tracked apart
+    ntp_device.start()  # NTP is polled by its own task
+    asyncio.create_task(one_second_coroutine())
+    boot.track("ntp synced", ntp_device.ntp_source.sampled.wait())
+
+BACKGROUND_STAGES = (("dht", start_dht), ("ntp start", start_ntp))
+
+async def background_boot():
+    await boot.run_stages(BACKGROUND_STAGES)
+    print(boot)
+    await boot.wait_tracked()
+    print(boot)
 
 #-------------------------- DCF77 GUI --------------------------------------
 # conversions table for Calendar
@@ -81,9 +116,9 @@ def fwdbutton(wri, row, col, cls_screen, text='Next'):
     
 
 #------------------------------------------------------------------------------
-class NTP_clock_screen(Screen):
-    def __init__(self):
-        super().__init__()
+class NTP_clock_screen(CachedScreen):
+    def build(self):
+        load_fonts()
         labels = {'bdcolor' : False,
                   'fgcolor' : YELLOW,
                   'bgcolor' : BLACK,
@@ -94,12 +129,12 @@ class NTP_clock_screen(Screen):
                   'bgcolor' : BLACK,
                   'justify' : Label.CENTRE,
           }
-        # verbose default indicates if fast rendering is enabled
-        wri         = CWriter(ssd, arial10, YELLOW, BLACK, verbose=False)  
-        wri_date    = CWriter(ssd, date_font, YELLOW, BLACK, verbose=False)  
-        wri_time    = CWriter(ssd, hours_font, YELLOW, BLACK, verbose=False)  
-        wri_seconds = CWriter(ssd, seconds_font, YELLOW, BLACK, verbose=False)  
-        wri_temp    = CWriter(ssd, seconds_font, YELLOW, BLACK, verbose=False)  
+        # writers are shared between screens, see screen_cache
+        wri         = get_writer(arial10, YELLOW, BLACK)
+        wri_date    = get_writer(date_font, YELLOW, BLACK)
+        wri_time    = get_writer(hours_font, YELLOW, BLACK)
+        wri_seconds = get_writer(seconds_font, YELLOW, BLACK)
+        wri_temp    = get_writer(seconds_font, YELLOW, BLACK)
         
         gap = 4  # Vertical gap between widgets
         
@@ -118,18 +153,36 @@ class NTP_clock_screen(Screen):
         self.lbl_hum_unit = Label(wri, row, col2, "%", **temp_colors)
         
         row = self.dial.mrow + gap
-        self.lbl_date = Label(wri_date, row, 2, 124, **labels)
+        # time, seconds and date are drawn from pre-rendered glyphs
+        get_glyph_cache(hours_font).preload("0123456789:")
+        get_glyph_cache(seconds_font).preload([f"{n:02d}" for n in range(60)])
+        self.lbl_date = GlyphLabel(wri_date, row, 2, 124, **labels)
         row = self.lbl_date.mrow + gap
-        self.lbl_tim = Label(wri_time, row, 2, '00:00', **labels)
+        self.lbl_tim = GlyphLabel(wri_time, row, 2, '00:00', **labels)
         self.led_status = LED(wri, row-gap, 105, height=10, bdcolor=False , fgcolor=False )
         row += 12
-        self.lbl_sec = Label(wri_seconds, row, 100, '00', **labels)
-        
-        dht11_device.set_clock( ntp_device)
+        self.lbl_sec = GlyphLabel(wri_seconds, row, 100, '00', **labels)
+
 
+        # only the bounding boxes of the changed widgets are sent to the display
+        self.dirty = DirtyRegions(ssd)
+
+        dht_pipeline.subscribe(self.on_dht_change)
         # setup async coroutines
         self.reg_task(self.aclock_screen())
 
+    def on_dht_change(self, timestamp, temperature, humidity):
+        self.lbl_temperature.value(f"{temperature:3.1f}")
+        self.lbl_humidity.value(f"{humidity:3.1f}")
+
+    def after_open(self):
+        super().after_open()
+        self.dirty.take_refresh()
+
+    def on_hide(self):
+        super().on_hide()
+        self.dirty.release_refresh()
+
     async def aclock_screen(self):
         def uv(phi):
             return rect(1, phi)
@@ -142,10 +195,7 @@ class NTP_clock_screen(Screen):
         sstart = 0 + 1j
     
         while True:
-            temperature  = dht11_device.get_temperature()
-            humidity = dht11_device.get_humidity()
-            self.lbl_temperature.value(f"{temperature:3.1f}")
-            self.lbl_humidity.value(f"{humidity:3.1f}")
+            await self.wait_visible()
             t = ntp_device.get_local_time()                        
             # Format
             ## localtime : t[0]:year, t[1]:month, t[2]:mday, t[3]:hour, t[4]:minute, t[5]:second, t[6]:weekday, t[7]:time_zone, t[8]:time_is_valid
@@ -159,23 +209,29 @@ class NTP_clock_screen(Screen):
             self.led_status.color(CYAN)
             if t[5]%2==0 : self.led_status(True)
             else: self.led_status(False)
+            self.dirty.mark_widget(self.dial)  # pointers are not tracked by the dial draw flag
+            D5.on()
+            await self.dirty.flush()
+            D5.off()
+            if boot.first_frame():
+                asyncio.create_task(background_boot())
             D3.off()
             await asyncio.timer_elapsed.wait()
             D3.on()
             asyncio.timer_elapsed.clear()            
             
 #------------------------------------------------------------------------------
-class NTP_data_screen(Screen):
-    def __init__(self):
-        super().__init__()
+class NTP_data_screen(CachedScreen):
+    def build(self):
+        load_fonts()
         labels = {'bdcolor' : False,
                   'fgcolor' : YELLOW,
                   'bgcolor' : DARKBLUE,
                   'justify' : Label.CENTRE,
           }
 
-        wri = CWriter(ssd, arial10, YELLOW, BLACK, verbose=False)  # Report on fast mode. Or use verbose=False
-        wri_time = CWriter(ssd, seconds_font, YELLOW, BLACK, verbose=False)  # Report on fast mode. Or use verbose=False
+        wri = get_writer(arial10, YELLOW, BLACK)
+        wri_time = get_writer(seconds_font, YELLOW, BLACK)
         gap = 4  # Vertical gap between widgets
 
         self.lbl_title = Label(wri, 4, 2, 'data')
@@ -197,6 +253,7 @@ class NTP_data_screen(Screen):
        
     async def adetail_screen(self):
         while True:
+            await self.wait_visible()
             t = ntp_device.get_local_time()
             # localtime : t[0]:year, t[1]:month, t[2]:mday, t[3]:hour, t[4]:minute, t[5]:second, t[6]:weekday, t[7]:time_zone
             self.lbl_date.value(f"{days[t[6]-1]} {t[2]:02d} {months[t[1]-1]} {t[3]:02d}:{t[4]:02d}:{t[5]:02d}")
@@ -207,18 +264,21 @@ class NTP_data_screen(Screen):
 
 #------------------------------------------------------------------------------
 RETRY_WLAN_CONNECT_STATUS = const(1) # in seconds
+# text log formats, the lines are formatted only when flushed to the Textbox
+WLAN_STATUS = register_format(explain_wlan_status)
+WLAN_CONFIG = register_format("{} =  {}")
 
-class NTP_init_screen(Screen):
-    def __init__(self):
-        super().__init__()
+class NTP_init_screen(CachedScreen):
+    def build(self):
+        load_fonts()
         labels = {'bdcolor' : False,
                   'fgcolor' : YELLOW,
                   'bgcolor' : DARKBLUE,
                   'justify' : Label.CENTRE,
           }
 
-        wri = CWriter(ssd, arial10, YELLOW, BLACK, verbose=False)  # Report on fast mode. Or use verbose=False
-        wri_time = CWriter(ssd, seconds_font, YELLOW, BLACK, verbose=False)  # Report on fast mode. Or use verbose=False
+        wri = get_writer(arial10, YELLOW, BLACK)
+        wri_time = get_writer(seconds_font, YELLOW, BLACK)
         gap = 4  # Vertical gap between widgets
 
         self.lbl_title = Label(wri, 4, 2, 'NTP init')
@@ -230,48 +290,45 @@ class NTP_init_screen(Screen):
         self.lbl_date = Label(wri, row, 2, 120, **labels)
         row = self.lbl_date.mrow + gap
         self.tb = Textbox(wri, row, 2, 120, 7)
+        self.log = TextLog()
 
         self.reg_task(self.as_init_screen())
+        self.reg_task(self.as_init_periodic_screen())
+        self.reg_task(self.log.run(self.tb, asyncio.timer_elapsed, self.wait_visible))
         
         
     async def as_init_screen(self):   
-        # async wifi connect and set time
-        if not ntp_device.time_is_valid():
-#             async_wifi_connect()
-            wlan.disconnect()
-            wlan.connect(SSID, PASSWORD)
-            for n in range(10):
-                D4.on()
-#                 status = uasyncio.run(get_connection_status())
-                status = wlan.status()
-                text = explain_wlan_status(status)
-                self.tb.append(text)
-                D4.off()
-                if status == network.STAT_GOT_IP:
-#                     wlan_config = wlan.ifconfig()
-#                     self.tb.append( f"my_ip =  {wlan_config[0]}" )
-                    ntp_device.set_time_validity(True)
-                    if ntp_device.set_ntp_time():
-                        t = ntp_device.get_local_time()            
-                    break
-                await uasyncio.sleep(RETRY_WLAN_CONNECT_STATUS)
-            t = ntp_device.get_local_time()
-            # localtime : t[0]:year, t[1]:month, t[2]:mday, t[3]:hour, t[4]:minute, t[5]:second, t[6]:weekday, t[7]:time_zone
-            self.lbl_date.value(f"{days[t[6]-1]} {t[2]:02d} {months[t[1]-1]} {t[3]:02d}:{t[4]:02d}:{t[5]:02d}")
-            await uasyncio.sleep(5)
-            Screen.change(NTP_clock_screen)
-        
-        self.reg_task(self.as_init_periodic_screen())
-       
-        
-    
-    
+        # async wifi connect and set time, restarted on each visit: the instance is cached
+        while True:
+            await self.wait_opened()
+            if not ntp_device.time_is_valid():
+#                 async_wifi_connect()
+                wlan.disconnect()
+                wlan.connect(SSID, PASSWORD)
+                for n in range(10):
+                    D4.on()
+#                     status = uasyncio.run(get_connection_status())
+                    status = wlan.status()
+                    self.log.log(WLAN_STATUS, status)
+                    D4.off()
+                    if status == network.STAT_GOT_IP:
+#                         wlan_config = wlan.ifconfig()
+#                         self.tb.append( f"my_ip =  {wlan_config[0]}" )
+                        # the NTP source task polls on its own once connected
+                        break
+                    await uasyncio.sleep(RETRY_WLAN_CONNECT_STATUS)
+                t = ntp_device.get_local_time()
+                # localtime : t[0]:year, t[1]:month, t[2]:mday, t[3]:hour, t[4]:minute, t[5]:second, t[6]:weekday, t[7]:time_zone
+                self.lbl_date.value(f"{days[t[6]-1]} {t[2]:02d} {months[t[1]-1]} {t[3]:02d}:{t[4]:02d}:{t[5]:02d}")
+                await uasyncio.sleep(5)
+                Screen.change(NTP_clock_screen)
+            wlan_config = wlan.ifconfig()
+            self.log.log(WLAN_CONFIG, "SSID ", SSID)
+            self.log.log(WLAN_CONFIG, "my_ip", wlan_config[0])
     
     async def as_init_periodic_screen(self):
-        wlan_config = wlan.ifconfig()
-        self.tb.append( f"SSID  =  {SSID}" )
-        self.tb.append( f"my_ip =  {wlan_config[0]}" )
         while True:
+            await self.wait_visible()
             t = ntp_device.get_local_time()
             # localtime : t[0]:year, t[1]:month, t[2]:mday, t[3]:hour, t[4]:minute, t[5]:second, t[6]:weekday, t[7]:time_zone
             self.lbl_date.value(f"{days[t[6]-1]} {t[2]:02d} {months[t[1]-1]} {t[3]:02d}:{t[4]:02d}:{t[5]:02d}")
@@ -283,7 +340,7 @@ class NTP_init_screen(Screen):
 #----------------- main program --------------------------
 
 if __name__ == "__main__":
-    Screen.change(NTP_init_screen)
+    Screen.change(NTP_clock_screen)
 
 
 
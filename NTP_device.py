@@ -5,6 +5,7 @@ from struct import unpack
 
 from lib_pico.wifi_device import *
 from lib_pico.NTP_client import *
+from lib_pico.local_clock import local_clock
 
 
 
@@ -19,26 +20,269 @@ DATAGRAM_SIZE = const(48)
 NTP_UDP_PORT = const(123)
 SERVER_REPLY_TIMOUT = const(1) # in seconds
 
+SOURCE_JITTER_DEPTH = const(8)   # number of offsets kept to estimate a source jitter
+AGE_PENALTY_MS = const(1)        # score penalty per second since the last good sample
+MAX_SLEW_MS = const(50)          # max correction applied per second when switching sources
+STEP_THRESHOLD_MS = const(10000) # above this offset the RTC is stepped instead of slewed
+SWITCH_HYSTERESIS = 0.8          # a new source must score 20% better to be selected
+RTC_SCORE = const(100000)        # RTC is the fallback, worse than any live source
+DCF_EDGE_POLL_MS = const(5)      # DCF77 decoder read period while waiting for its second to change
+DCF_EDGE_TIMEOUT_MS = const(1500)
+
+class TimeSource():
+    """ pluggable time provider.
+    poll() returns the offset in ms of the source versus the RTC (RTC holds local time),
+    and its error estimate in ms, or None when the source does not answer.
+    Sources whose poll may block (network) set background = True and are polled
+    by their own task, run(arbiter): the arbiter only uses their latest sample."""
+    background = False
+
+    def __init__(self, name, poll_interval, max_age, retry_interval=10):
+        self.name = name
+        self.poll_interval = poll_interval   # in seconds
+        self.retry_interval = retry_interval # in seconds, after a poll without answer
+        self.max_age = max_age               # in seconds, older samples mean the source is silent
+        self.offset_ms = 0
+        self.error_ms = 0
+        self._offsets = []
+        self._last_sample = None
+        self._last_poll = None
+        self._answered = False
+        self.sampled = asyncio.Event()  # set on the first good sample
+
+    def poll(self):
+        return None
+
+    async def async_poll(self):
+        return self.poll()
+
+    def is_due(self, now):
+        if self._last_poll is None:
+            return True
+        interval = self.poll_interval if self._answered else self.retry_interval
+        return now - self._last_poll >= interval
+
+    def update(self, now):
+        self._last_poll = now
+        return self.record(now, self.poll())
+
+    async def run(self, arbiter):
+        """ background polling task, checks once per second if a poll is due"""
+        while True:
+            if self.is_due(arbiter.uptime):
+                self._last_poll = arbiter.uptime
+                sample = await self.async_poll()
+                self.record(arbiter.uptime, sample)
+            await asyncio.sleep(1)
+
+    def record(self, now, sample):
+        self._answered = sample is not None
+        if sample is None:
+            return False
+        self.offset_ms, self.error_ms = sample
+        self.sampled.set()
+        self._offsets.append(self.offset_ms)
+        if len(self._offsets) > SOURCE_JITTER_DEPTH:
+            self._offsets.pop(0)
+        self._last_sample = now
+        return True
+
+    def shift(self, ms):
+        """ keeps stored offsets consistent when the RTC is stepped by ms"""
+        self.offset_ms -= ms
+        self._offsets = [o - ms for o in self._offsets]
+
+    def jitter_ms(self):
+        n = len(self._offsets)
+        if n < 2:
+            return 0
+        d2 = 0
+        for i in range(1, n):
+            d = self._offsets[i] - self._offsets[i-1]
+            d2 += d * d
+        return int((d2 / (n - 1)) ** 0.5)
+
+    def age(self, now):
+        return None if self._last_sample is None else now - self._last_sample
+
+    def score(self, now):
+        """ lower is better, None when the source is silent"""
+        age = self.age(now)
+        if age is None or age > self.max_age:
+            return None
+        return abs(self.error_ms) + self.jitter_ms() + age * AGE_PENALTY_MS
+
+    def __repr__(self):
+        return f"{self.name}: offset {self.offset_ms} ms | error {self.error_ms} ms | jitter {self.jitter_ms()} ms"
+
+
+class RTCsource(TimeSource):
+    """ the local RTC, always available, used as last resort"""
+    def __init__(self):
+        super().__init__("RTC", 1, 0)
+
+    def shift(self, ms):
+        pass
+
+    def score(self, now):
+        return RTC_SCORE
+
+
+class NTPsource(TimeSource):
+    """ polled by its own task: Wi-Fi connection and NTP exchange never block the one-second tick"""
+    background = True
+
+    def __init__(self, time_zone, poll_interval=1024, max_age=4096, capture=None):
+        super().__init__("NTP", poll_interval, max_age)
+        self.time_zone = time_zone
+        self.capture = capture
+        self.frame = None
+        self.server = None
+        self.wlan = None
+
+    def shift(self, ms):
+        """ also moves the local stamps kept by the NTP client, including those of a poll in
+        progress, so that the next (interleaved) offset is measured against the stepped RTC"""
+        super().shift(ms)
+        shift_local_time(ms * 1000)
+
+    async def async_poll(self):
+        if self.wlan is None:
+            self.wlan = WiFiDevice()
+        if not network.WLAN(network.STA_IF).isconnected():
+            self.wlan.wifi_connect()
+            if not await self.wlan.async_wait_connection():
+                return None
+        reply = await async_get_ntp_time(self.time_zone, self.capture)
+        if reply == 0 or not reply[1].is_valid:
+            return None
+        ntp_time, self.frame, self.server = reply
+        # RTC holds local time, NTP gives UTC
+        offset_ms = self.frame.offset_us // 1000 + self.time_zone * 3600 * 1000
+        return offset_ms, self.frame.delay_us // 2000
+
+
+class DCF77source(TimeSource):
+    """ wraps a DCF77 decoder exposing get_local_time() in the common format.
+    The decoder only gives whole seconds : its own task waits for the decoded second
+    to change and compares it with the sub-second local time of that edge"""
+    background = True
+
+    def __init__(self, dcf_clock, error_ms=20, max_age=180):
+        super().__init__("DCF77", 60, max_age)
+        self.dcf_clock = dcf_clock
+        self.default_error_ms = error_ms
+
+    async def async_poll(self):
+        if not local_clock.is_anchored():
+            await local_clock.async_anchor()
+        second = self.dcf_clock.get_local_time()[5]
+        before = local_clock.time_us()
+        deadline = before + DCF_EDGE_TIMEOUT_MS * 1000
+        while True:
+            await asyncio.sleep_ms(DCF_EDGE_POLL_MS)
+            t = self.dcf_clock.get_local_time()
+            now = local_clock.time_us()
+            if t[5] != second:
+                break
+            if now > deadline:
+                return None
+            before = now
+        if not t[8]:
+            return None
+        dcf_sec = time.mktime((t[0], t[1], t[2], t[3], t[4], t[5], t[6], 0))
+        # the decoded second started between the two reads
+        edge_us = (before + now) // 2
+        return (dcf_sec * 10**6 - edge_us) // 1000, self.default_error_ms + (now - before) // 2000
+
+
+class TimeArbiter():
+    """ selects the best scored source and slews the local time toward it,
+    falls back on the next source, ultimately the RTC, when one goes silent."""
+    def __init__(self, sources):
+        self.sources = sources
+        self.selected = sources[-1]
+        self.correction_ms = 0   # added to the RTC to give the local time
+        self.uptime = 0          # in seconds, monotonic whatever the RTC steps
+
+    def add_source(self, source):
+        self.sources.insert(0, source)
+
+    def next_second(self):
+        self.uptime += 1
+        now = self.uptime
+        for source in self.sources:
+            if not source.background and source.is_due(now):
+                source.update(now)
+        best, best_score = None, None
+        for source in self.sources:
+            score = source.score(now)
+            if score is not None and (best_score is None or score < best_score):
+                best, best_score = source, score
+        current_score = self.selected.score(now)
+        if best is not self.selected and (current_score is None or best_score < current_score * SWITCH_HYSTERESIS):
+            self.selected = best
+        if not isinstance(self.selected, RTCsource):
+            self._slew(self.selected.offset_ms)
+        # else holdover : keep the last correction
+
+    def _slew(self, target_ms):
+        error = target_ms - self.correction_ms
+        if abs(error) > STEP_THRESHOLD_MS:
+            # far off, e.g. first synchronisation : step the local clock, and the RTC to the second.
+            # The sources are shifted by the step applied, to the second when not yet anchored
+            step_ms = local_clock.step(target_ms * 1000) // 1000
+            for source in self.sources:
+                source.shift(step_ms)
+            self.correction_ms = 0
+            error = self.selected.offset_ms
+        self.correction_ms += max(-MAX_SLEW_MS, min(MAX_SLEW_MS, error))
+
+    def is_synchronised(self):
+        """ True while the selected source is a live one, False in RTC holdover"""
+        return self.selected.score(self.uptime) is not None and not isinstance(self.selected, RTCsource)
+
+    def now_ms(self):
+        """ RTC seconds and ticks_us() in between, see local_clock.py, plus the slew correction"""
+        return local_clock.time_us() // 1000 + self.correction_ms
+
+    def __repr__(self):
+        s = f"time arbiter: selected {self.selected.name} | correction {self.correction_ms} ms"
+        for source in self.sources:
+            s += f"\n\t{source}"
+        return s
+
+
 class NTPdevice():
     def __init__(self, time_zone=CEST_OFFSET):
         self.time_zone = time_zone
         self._time_validity = False
+        self.ntp_source = NTPsource(time_zone)
+        self.arbiter = TimeArbiter([self.ntp_source, RTCsource()])
+
+    def add_source(self, source):
+        """ e.g. ntp_device.add_source(DCF77source(dcf_clock))"""
+        self.arbiter.add_source(source)
+
+    def start(self):
+        """ starts the polling tasks of the background sources (NTP), next_second() does the rest"""
+        for source in self.arbiter.sources:
+            if source.background:
+                asyncio.create_task(source.run(self.arbiter))
 
     def time_is_valid(self):
         return self._time_validity
-    
+
+    def next_second(self):
+        """ to be called once per second : polls the due sources and slews the local time"""
+        self.arbiter.next_second()
+        # cleared again when the live sources age out and the RTC holds over
+        self._time_validity = self.arbiter.is_synchronised()
+
     def get_local_time(self):
         """ gives time compliant with format expected by clock GUI.
         Unifyed format between ntp, RTC and DCF77"""
-        if not self._time_validity:
-            wlan = WiFiDevice()
-            wlan.wifi_connect()
-            if wlan.blocking_wait_connection():
-                self._time_validity = True
-                ntp_time,frame,server = get_ntp_time(self.time_zone)
-                settime(ntp_time)
-        t_RTC = time.gmtime()                
-        t = list(t_RTC)
+        t = list(time.gmtime(self.arbiter.now_ms() // 1000))
         t[7] = self.time_zone
         t.append(self._time_validity)
         # t Format:
@@ -48,20 +292,7 @@ class NTPdevice():
     async def async_get_local_time(self):
         """ gives time compliant with format expected by clock GUI.
         Unifyed format between ntp, RTC and DCF77"""
-        if not self._time_validity:
-            wlan = WiFiDevice()
-            wlan.wifi_connect()
-            if wlan.async_wait_connection():
-                self._time_validity = True
-                ntp_time,frame,server = get_ntp_time(self.time_zone)
-                settime(ntp_time)
-        t_RTC = time.gmtime()                
-        t = list(t_RTC)
-        t[7] = self.time_zone
-        t.append(self._time_validity)
-        # t Format:
-        ## common_format : t[0]:year, t[1]:month, t[2]:mday, t[3]:hour, t[4]:minute, t[5]:second, t[6]:weekday, t[7]:time_zone, t[8]=time_validity
-        return t
+        return self.get_local_time()
            
     
 ###############################################################################
@@ -78,6 +309,7 @@ if __name__ == "__main__":
     
     #--------------------------------------------------------------------------    
     ntp_device = NTPdevice()
+    ntp_device.start()
     
     #--------------------------------------------------------------------------    
     def timer_IRQ(timer):
@@ -89,6 +321,7 @@ if __name__ == "__main__":
             await one_second_time_event.wait()
             D7.on()
             one_second_time_event.clear()
+            ntp_device.next_second()
             print(f"local time: {ntp_device.get_local_time()}")
 
 
@@ -0,0 +1,65 @@
+# xiansnn : NTP datagram layout and timestamp arithmetic
+#
+# Pure helpers shared by NTP_client.py (on the Pico) and NTP_replay.py (on the
+# Pico or a desktop python): no machine, socket nor RTC import here, so that
+# the capture replay decodes exactly like the client.
+
+import struct
+try:
+    from micropython import const
+except ImportError:  # desktop python
+    const = lambda x: x
+
+CLIENT_MODE = const(3)
+SERVER_MODE = const(4)
+SNTP_VERSION = const(4)
+CLOCK_OUT_OF_SYNC = const(3)
+DGRAM_SIZE = const(48)
+
+# (date(2000, 1, 1) - date(1900, 1, 1)).days * 24*60*60
+# (date(1970, 1, 1) - date(1900, 1, 1)).days * 24*60*60
+TIME_STAMP_UNIX = const(2208988800) # first day for UNIX epoch 1970-01-01 00:00
+TIME_STAMP_2000 = const(3155673600)
+
+# capture file record : local T1 (NTP seconds, NTP fraction), send ticks_us, receive ticks_us, raw reply
+CAPTURE_HEADER_FORMAT = "!IIII"
+CAPTURE_HEADER_SIZE = const(16)
+CAPTURE_RECORD_SIZE = const(64) # CAPTURE_HEADER_SIZE + DGRAM_SIZE
+# local clock step record : T1 seconds = 0 (never a real T1), T1 fraction = flags, the step in us
+# as a signed 64 bits integer in place of the reply. The step always applies to the previous
+# exchange. With CAPTURE_STEP_IN_FLIGHT, it also applies to the exchange of the next record.
+CAPTURE_STEP_MARKER = const(0)
+CAPTURE_STEP_IN_FLIGHT = const(1)
+CAPTURE_STEP_FORMAT = "!q"
+
+# datagram field offsets
+ORIGIN_OFFSET = const(24)
+RECEIVE_OFFSET = const(32)
+TRANSMIT_OFFSET = const(40)
+
+
+def ts_diff_us(sec_a, frac_a, sec_b, frac_b):
+    """ difference a - b of two NTP timestamps in microseconds, computed on integers"""
+    return (sec_a - sec_b) * 10**6 + (((frac_a - frac_b) * 10**6) >> 32)
+
+def ts_add_us(sec, frac, us):
+    """ NTP timestamp (sec, frac) + us microseconds"""
+    s, u = divmod(us, 10**6)
+    frac += (u << 32) // 10**6
+    return sec + s + (frac >> 32), frac & 0xFFFFFFFF
+
+def decode_mode(msg, start=0):
+    """ (leap indicator, mode) of the datagram at msg[start:]"""
+    return (msg[start] & 0xC0) >> 6, msg[start] & 7
+
+def decode_timestamps(msg, start=0):
+    """ origin, receive and transmit timestamps of the datagram at msg[start:], as (sec, frac)"""
+    o_sec, o_frac, r_sec, r_frac, t_sec, t_frac = struct.unpack_from("!IIIIII", msg, start + ORIGIN_OFFSET)
+    return (o_sec, o_frac), (r_sec, r_frac), (t_sec, t_frac)
+
+def offset_delay_us(t1, t2, t3, t4):
+    """ RFC 4330 offset and delay in microseconds, from the four (sec, frac) timestamps"""
+    d21 = ts_diff_us(t2[0], t2[1], t1[0], t1[1])
+    d34 = ts_diff_us(t3[0], t3[1], t4[0], t4[1])
+    delay = ts_diff_us(t4[0], t4[1], t1[0], t1[1]) - ts_diff_us(t3[0], t3[1], t2[0], t2[1])
+    return (d21 + d34) // 2, delay
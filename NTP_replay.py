@@ -0,0 +1,182 @@
+# xiansnn : replay of NTP captures recorded by NTP_client.NTPcapture
+#
+# Runs on the Pico as well as on a desktop python, so that weeks of captures
+# can be analysed off-device:
+#     python NTP_replay.py ntp_capture.bin
+#
+# The capture file is read by chunks into a single preallocated buffer.
+# Each record is decoded in place by the NTP_protocol helpers shared with
+# NTPframe, no per-record buffer nor NTPframe object is built on the bulk path.
+
+import struct
+try:
+    from lib_pico.NTP_protocol import *
+except ImportError:  # desktop python, run from the repository directory
+    from NTP_protocol import *
+
+RECORDS_PER_CHUNK = 64
+TICKS_PERIOD = 1 << 30  # MicroPython ticks_us() wrap around value
+FRAC = 2**-32
+
+def ticks_diff_us(end, start):
+    d = (end - start) & (TICKS_PERIOD - 1)
+    if d >= TICKS_PERIOD // 2:
+        d -= TICKS_PERIOD
+    return d
+
+
+class Statistics():
+    """ running mean/std-dev (Welford), min and max of a serie of values"""
+    def __init__(self, name):
+        self.name = name
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, x):
+        self.n += 1
+        d = x - self.mean
+        self.mean += d / self.n
+        self._m2 += d * (x - self.mean)
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+
+    def std(self):
+        return (self._m2 / (self.n - 1)) ** 0.5 if self.n > 1 else 0.0
+
+    def __repr__(self):
+        if self.n == 0:
+            return f"{self.name}: no data"
+        return (f"{self.name}: mean {self.mean*1000:.3f} ms | std {self.std()*1000:.3f} ms"
+                f" | min {self.min*1000:.3f} ms | max {self.max*1000:.3f} ms")
+
+
+class NTPreplay():
+    """ streams a capture file and computes offset, delay and stability reports.
+    offset and delay follow RFC 4330, computed by NTP_protocol.offset_delay_us() as in the client :
+        delay  = (T4 - T1) - (T3 - T2)
+        offset = ((T2 - T1) + (T3 - T4)) / 2
+    T1 is the local time recorded at send, T4 = T1 + (receive ticks - send ticks).
+    Interleaved replies (origin = previous T4) are computed on the previous exchange,
+    like NTP_client.NTPclient does, with its stamps moved by the recorded local clock steps."""
+    def __init__(self, filename="ntp_capture.bin"):
+        self.filename = filename
+        self._buffer = bytearray(CAPTURE_RECORD_SIZE * RECORDS_PER_CHUNK)
+        self.offset = Statistics("offset")
+        self.delay = Statistics("delay")
+        self.records = 0
+        self.invalid = 0
+        # least square fit of offset versus local time gives the frequency error
+        self._first_t1 = None
+        self._last_t1 = 0.0
+        self._sx = self._sy = self._sxx = self._sxy = 0.0
+        # successive offset differences give the short term stability
+        self._last_offset = None
+        self.offset_step = Statistics("offset step")
+        self.interleaved = 0
+        self.steps = 0
+        self._prev = None   # (T1, T2, T4) of the previous valid record, as (sec, frac)
+        self._pending_step_us = 0  # step of the exchange of the next record
+
+    def run(self):
+        mv = memoryview(self._buffer)
+        with open(self.filename, "rb") as f:
+            while True:
+                n = f.readinto(self._buffer)
+                if not n:
+                    break
+                for start in range(0, n - CAPTURE_RECORD_SIZE + 1, CAPTURE_RECORD_SIZE):
+                    self._decode(mv, start)
+        return self
+
+    def _step(self, us, in_flight):
+        """ local clock step recorded by the client : same moves of the local stamps as NTPclient.shift_local()"""
+        self.steps += 1
+        prev = self._prev
+        if prev is not None:
+            self._prev = (ts_add_us(prev[0][0], prev[0][1], us), prev[1], ts_add_us(prev[2][0], prev[2][1], us))
+        if in_flight:
+            self._pending_step_us += us
+
+    def _decode(self, mv, start):
+        t1_sec, t1_frac, send_ticks, recv_ticks = struct.unpack_from(CAPTURE_HEADER_FORMAT, mv, start)
+        msg = start + CAPTURE_HEADER_SIZE
+        if t1_sec == CAPTURE_STEP_MARKER:
+            self._step(struct.unpack_from(CAPTURE_STEP_FORMAT, mv, msg)[0], t1_frac & CAPTURE_STEP_IN_FLIGHT)
+            return
+        self.records += 1
+        step_us = self._pending_step_us
+        self._pending_step_us = 0
+        li, mode = decode_mode(mv, msg)
+        if li == CLOCK_OUT_OF_SYNC or mode != SERVER_MODE:
+            self.invalid += 1
+            return
+        origin, t2, t3 = decode_timestamps(mv, msg)
+        if t3[0] == 0:
+            self.invalid += 1
+            return
+        t1 = (t1_sec, t1_frac)
+        t4 = ts_add_us(t1_sec, t1_frac, ticks_diff_us(recv_ticks, send_ticks))
+        prev = self._prev
+        # origin is checked against the stamps sent, before the steps of this exchange
+        basic = origin == t1
+        sent_rx = None
+        if prev is not None:
+            sent_rx = ts_add_us(prev[2][0], prev[2][1], -step_us) if step_us else prev[2]
+        if step_us:
+            t1 = ts_add_us(t1[0], t1[1], step_us)
+            t4 = ts_add_us(t4[0], t4[1], step_us)
+        if basic or origin == (0, 0):  # zero : captured before the client sent its transmit timestamp
+            self._prev = (t1, t2, t4)
+        elif origin == sent_rx:
+            self.interleaved += 1
+            self._prev = (t1, t2, t4)
+            t1, t2, t4 = prev
+        else:
+            self.invalid += 1  # a forged or stale reply does not replace the previous exchange
+            return
+        offset_us, delay_us = offset_delay_us(t1, t2, t3, t4)
+        offset = offset_us * 1e-6
+        delay = delay_us * 1e-6
+        t1 = t1[0] + t1[1] * FRAC
+        self.delay.add(delay)
+        self.offset.add(offset)
+        if self._last_offset is not None:
+            self.offset_step.add(offset - self._last_offset)
+        self._last_offset = offset
+        if self._first_t1 is None:
+            self._first_t1 = t1
+        x = t1 - self._first_t1
+        self._last_t1 = x
+        self._sx += x
+        self._sy += offset
+        self._sxx += x * x
+        self._sxy += x * offset
+
+    def drift_ppm(self):
+        n = self.offset.n
+        den = n * self._sxx - self._sx * self._sx
+        if n < 2 or den == 0:
+            return 0.0
+        return (n * self._sxy - self._sx * self._sy) / den * 1e6
+
+    def __repr__(self):
+        s = f"NTP replay: {self.filename}"
+        s += f"\n\trecords: {self.records} | invalid: {self.invalid} | interleaved: {self.interleaved} | steps: {self.steps} | span: {self._last_t1/3600:.2f} h"
+        s += f"\n\t{self.offset}"
+        s += f"\n\t{self.delay}"
+        s += f"\n\t{self.offset_step}"
+        s += f"\n\tlocal clock drift: {self.drift_ppm():.3f} ppm"
+        return s
+
+
+###############################################################################
+if __name__ == "__main__":
+    import sys
+    argv = getattr(sys, "argv", [])
+    filename = argv[1] if len(argv) > 1 else "ntp_capture.bin"
+    print(NTPreplay(filename).run())
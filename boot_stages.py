@@ -0,0 +1,72 @@
+# xiansnn : staged startup timing
+#
+# The clock is drawn from the RTC first, the slow parts of the startup
+# (sensors, wifi, NTP) run afterwards as background stages.
+#     boot = BootStages()          # as early as possible
+#     with boot.stage("fonts"):
+#         ...
+#     boot.first_frame()
+#     await boot.run_stages(background_stages)
+#     print(boot)
+# A stage function must only start its work (e.g. create a task), the time of
+# completion of that work is measured separately with track():
+#     boot.track("ntp synchronised", ntp_source.sampled.wait())
+
+import uasyncio as asyncio
+from time import ticks_ms, ticks_diff
+
+
+class BootStages():
+    def __init__(self):
+        self.t0 = ticks_ms()
+        self.stages = []   # (name, start ms, duration ms), start relative to t0
+        self.first_frame_ms = None
+        self._name = None
+        self._start = 0
+        self._tracked = []  # tasks started by track()
+
+    def stage(self, name):
+        self._name = name
+        return self
+
+    def __enter__(self):
+        self._start = ticks_ms()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = ticks_ms()
+        self.stages.append((self._name, ticks_diff(self._start, self.t0), ticks_diff(end, self._start)))
+        return False
+
+    def first_frame(self):
+        """ returns True only on the first call"""
+        if self.first_frame_ms is not None:
+            return False
+        self.first_frame_ms = ticks_diff(ticks_ms(), self.t0)
+        return True
+
+    async def run_stages(self, stages):
+        """ stages : sequence of (name, function), each one is timed,
+        the scheduler runs in between so that the display keeps ticking"""
+        for name, func in stages:
+            await asyncio.sleep_ms(0)
+            with self.stage(name):
+                func()
+
+    def track(self, name, awaitable):
+        """ records name as a stage lasting from now until awaitable completes"""
+        async def wait():
+            start = ticks_ms()
+            await awaitable
+            self.stages.append((name, ticks_diff(start, self.t0), ticks_diff(ticks_ms(), start)))
+        self._tracked.append(asyncio.create_task(wait()))
+
+    async def wait_tracked(self):
+        for task in self._tracked:
+            await task
+
+    def __repr__(self):
+        s = f"boot: first frame at {self.first_frame_ms} ms"
+        for name, start, duration in self.stages:
+            s += f"\n\t{name:12s} start {start:6d} ms | duration {duration:6d} ms"
+        return s
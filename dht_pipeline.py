@@ -0,0 +1,93 @@
+# xiansnn : DHT11 sampling pipeline decoupled from the display tick
+#
+# The sensor is read once per period, phase_ms after a one-second tick, so
+# that the pulse train decoding never overlaps the render done on the second
+# edge. Raw readings go through a median filter, then subscribers are called:
+#   - every_sample subscribers on each filtered sample (e.g. history)
+#   - the others only when the filtered value changes (e.g. labels)
+# callback signature : callback(timestamp, temperature, humidity)
+#
+# sensor : any object with measure(), temperature(), humidity(), such as the
+# firmware driver dht.DHT11(Pin(n)).
+
+import uasyncio as asyncio
+from time import ticks_ms, ticks_diff
+
+DHT_PHASE_MS = const(300)   # after the second edge render, before the scheduled GC
+MEDIAN_DEPTH = const(5)
+
+
+def median(values):
+    s = sorted(values)
+    return s[(len(s) - 1) // 2]
+
+
+class DHTpipeline():
+    def __init__(self, period=60, phase_ms=DHT_PHASE_MS, depth=MEDIAN_DEPTH, clock=None):
+        self.period = period
+        self.phase_ms = phase_ms
+        self.depth = depth
+        self.clock = clock        # callable returning the timestamp in seconds
+        self.sensor = None
+        self._temperatures = []
+        self._humidities = []
+        self._on_change = []
+        self._every_sample = []
+        self.temperature = None
+        self.humidity = None
+        self.timestamp = None
+        self.samples = 0
+        self.errors = 0
+        self.measure_ms = 0
+
+    def subscribe(self, callback, every_sample=False):
+        if every_sample:
+            self._every_sample.append(callback)
+        else:
+            self._on_change.append(callback)
+        if self.timestamp is not None and not every_sample:
+            callback(self.timestamp, self.temperature, self.humidity)
+
+    def start(self, sensor, tick_event):
+        self.sensor = sensor
+        asyncio.create_task(self.run(tick_event))
+
+    def _filter(self, values, value):
+        values.append(value)
+        if len(values) > self.depth:
+            values.pop(0)
+        return median(values)
+
+    def sample(self):
+        t0 = ticks_ms()
+        try:
+            self.sensor.measure()
+        except OSError:  # checksum or timeout error
+            self.errors += 1
+            return
+        self.measure_ms = ticks_diff(ticks_ms(), t0)
+        temperature = self._filter(self._temperatures, self.sensor.temperature())
+        humidity = self._filter(self._humidities, self.sensor.humidity())
+        timestamp = self.clock() if self.clock is not None else 0
+        changed = temperature != self.temperature or humidity != self.humidity
+        self.temperature, self.humidity, self.timestamp = temperature, humidity, timestamp
+        self.samples += 1
+        for callback in self._every_sample:
+            callback(timestamp, temperature, humidity)
+        if changed:
+            for callback in self._on_change:
+                callback(timestamp, temperature, humidity)
+
+    async def run(self, tick_event):
+        countdown = 0
+        while True:
+            await tick_event.wait()
+            await asyncio.sleep_ms(self.phase_ms)
+            if countdown == 0:
+                self.sample()
+                countdown = self.period
+            countdown -= 1
+
+    def __repr__(self):
+        return (f"DHT pipeline: {self.temperature}C {self.humidity}% | samples {self.samples}"
+                f" | errors {self.errors} | measure {self.measure_ms} ms")
@@ -0,0 +1,188 @@
+# xiansnn : partial display refresh for the clock screens
+#
+# By default microGUI redraws the stale widgets and pushes the whole
+# framebuffer to the display on each refresh. While a screen holds the
+# refresh (take_refresh), DirtyRegions.flush() redraws the stale widgets and
+# sends only their bounding boxes through a windowed write:
+#     - ssd.show_rect(x, y, w, h) when the display driver offers it
+#     - SSD1351window for the SSD1351 driver of the clock (128x128, GS8 framebuffer)
+# With any other driver the refresh is left to microGUI (its async
+# do_refresh or show) and DirtyRegions only tracks the regions.
+# A microGUI do_refresh may still be running when the refresh is taken:
+# the first flush waits for its rfsh_done before using the bus.
+
+import micropython
+import uasyncio as asyncio
+from array import array
+from time import ticks_us, ticks_diff
+from gui.core.ugui import Screen
+
+MAX_DIRTY_REGIONS = const(8)
+BORDER = const(2)  # widget borders are drawn around their bounding box
+REFRESH_DONE_TIMEOUT_MS = const(200)  # microGUI idle, no rfsh_done to come
+
+SSD1351_SET_COLUMN = b'\x15'
+SSD1351_SET_ROW = b'\x75'
+SSD1351_WRITE_RAM = b'\x5c'
+
+
+@micropython.viper
+def _rgb332_to_565(dest:ptr8, source:ptr8, length:int):
+    # same conversion as the SSD1351 driver show(), on one row segment
+    n = 0
+    for x in range(length):
+        c = source[x]
+        dest[n] = (c & 0xe0) | ((c & 0x1c) >> 2)
+        dest[n + 1] = (c & 3) << 3
+        n += 2
+
+
+class SSD1351window():
+    """ windowed write for the SSD1351 driver : sets the column and row address
+    of the rectangle, then pushes only its rows from the GS8 framebuffer"""
+    def __init__(self, device):
+        self.device = device
+        self._mvb = memoryview(device.buffer)
+        self._linebuf = bytearray(device.width * 2)
+        self._mvl = memoryview(self._linebuf)
+
+    def _window(self, x0, y0, x1, y1):
+        d = self.device
+        d._write(SSD1351_SET_COLUMN, 0)
+        d._write(bytes((x0, x1)), 1)
+        d._write(SSD1351_SET_ROW, 0)
+        d._write(bytes((y0, y1)), 1)
+
+    def show_rect(self, x, y, w, h):
+        d = self.device
+        wd = d.width
+        self._window(x, y, x + w - 1, y + h - 1)
+        d._write(SSD1351_WRITE_RAM, 0)
+        lb = self._mvl[:2 * w]
+        d.pindc(1)
+        d.pincs(0)
+        start = y * wd + x
+        for row in range(h):
+            _rgb332_to_565(lb, self._mvb[start:start + w], w)
+            d.spi.write(lb)
+            start += wd
+        d.pincs(1)
+
+    def restore(self):
+        """ full screen window, as expected by the driver show()"""
+        self._window(0, 0, self.device.width - 1, self.device.height - 1)
+
+
+def get_window_writer(device):
+    """ object offering show_rect(x, y, w, h) for device, None if not supported"""
+    if hasattr(device, "show_rect"):
+        return device
+    if type(device).__name__ == "SSD1351" and len(device.buffer) == device.width * device.height:
+        return SSD1351window(device)
+    return None
+
+class DirtyRegions():
+    def __init__(self, device, max_regions=MAX_DIRTY_REGIONS):
+        self.device = device
+        self.max_regions = max_regions
+        self._boxes = array('h', [0] * (4 * max_regions))  # x0, y0, x1, y1
+        self.count = 0
+        self.window = get_window_writer(device)
+        self.partial = self.window is not None
+        self._held = False      # refresh taken from microGUI
+        self._bus_wait = False  # a microGUI refresh may still be using the bus
+        self.flushes = 0
+        self.last_flush_us = 0
+        self.max_flush_us = 0
+        self._total_flush_us = 0
+
+    def take_refresh(self):
+        """ stops microGUI auto refresh, the next flush pushes the whole screen.
+        Without windowed write the refresh stays with microGUI"""
+        if not self.partial:
+            return
+        Screen.rfsh_start.clear()
+        self._held = True
+        self._bus_wait = True
+        self.mark(0, 0, self.device.width, self.device.height)
+
+    def release_refresh(self):
+        if not self.partial:
+            return
+        self._held = False
+        if not self._bus_wait and hasattr(self.window, "restore"):
+            self.window.restore()  # the window was only moved once the bus was ours
+        Screen.rfsh_start.set()
+
+    async def _wait_bus(self):
+        # rfsh_done is set after each microGUI refresh, clear it to wait for the running one
+        Screen.rfsh_done.clear()
+        try:
+            await asyncio.wait_for_ms(Screen.rfsh_done.wait(), REFRESH_DONE_TIMEOUT_MS)
+        except asyncio.TimeoutError:
+            pass  # no refresh was running
+        self._bus_wait = False
+
+    def mark(self, x, y, w, h):
+        x1 = min(x + w, self.device.width)
+        y1 = min(y + h, self.device.height)
+        x = max(x, 0)
+        y = max(y, 0)
+        if x >= x1 or y >= y1:
+            return
+        b = self._boxes
+        for i in range(0, 4 * self.count, 4):
+            # merge with an overlapping or adjacent box
+            if x <= b[i+2] and b[i] <= x1 and y <= b[i+3] and b[i+1] <= y1:
+                b[i] = min(b[i], x)
+                b[i+1] = min(b[i+1], y)
+                b[i+2] = max(b[i+2], x1)
+                b[i+3] = max(b[i+3], y1)
+                return
+        if self.count == self.max_regions:
+            # no room left, grow the last box
+            i = 4 * (self.count - 1)
+            b[i] = min(b[i], x)
+            b[i+1] = min(b[i+1], y)
+            b[i+2] = max(b[i+2], x1)
+            b[i+3] = max(b[i+3], y1)
+            return
+        i = 4 * self.count
+        b[i] = x
+        b[i+1] = y
+        b[i+2] = x1
+        b[i+3] = y1
+        self.count += 1
+
+    def mark_widget(self, widget):
+        self.mark(widget.col - BORDER, widget.row - BORDER, widget.width + 2 * BORDER, widget.height + 2 * BORDER)
+
+    async def flush(self):
+        """ redraws the stale widgets and sends their boxes. Returns the flush time in us,
+        0 when the refresh is left to microGUI"""
+        if self.partial and self._bus_wait:
+            await self._wait_bus()
+        if not self.partial or not self._held:
+            self.count = 0
+            return 0
+        t0 = ticks_us()
+        for obj in Screen.current_screen.displaylist:
+            if obj.draw:
+                self.mark_widget(obj)
+        Screen.show(False)  # redraw stale widgets in the framebuffer, no physical refresh
+        b = self._boxes
+        for i in range(0, 4 * self.count, 4):
+            self.window.show_rect(b[i], b[i+1], b[i+2] - b[i], b[i+3] - b[i+1])
+        self.count = 0
+        dt = ticks_diff(ticks_us(), t0)
+        self.flushes += 1
+        self.last_flush_us = dt
+        self.max_flush_us = max(self.max_flush_us, dt)
+        self._total_flush_us += dt
+        return dt
+
+    def __repr__(self):
+        if not self.partial:
+            return "flush: refresh left to microGUI, no windowed write for this display"
+        mean = self._total_flush_us // self.flushes if self.flushes else 0
+        return f"flush (windowed): last {self.last_flush_us} us | mean {mean} us | max {self.max_flush_us} us"
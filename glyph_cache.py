@@ -0,0 +1,133 @@
+# xiansnn : pre-rendered glyphs and strings for labels refreshed every second
+#
+# CWriter looks up and wraps each glyph in a new FrameBuffer on every print.
+# GlyphCache keeps these FrameBuffers, and optionally whole strings such as
+# "00" ... "59", so that a GlyphLabel redraw is only one blit per glyph
+# (or per string). The cache is bounded in bytes, least recently used
+# entries are evicted first.
+
+import framebuf
+from collections import OrderedDict
+from gui.core.ugui import Widget, ssd
+from gui.widgets import Label
+
+GLYPH_CACHE_MAX_BYTES = const(8192)
+
+_caches = {}
+
+def get_glyph_cache(font, max_bytes=GLYPH_CACHE_MAX_BYTES):
+    """ GlyphCache shared by all labels using font"""
+    cache = _caches.get(font)
+    if cache is None:
+        cache = GlyphCache(font, max_bytes)
+        _caches[font] = cache
+    return cache
+
+
+class GlyphCache():
+    def __init__(self, font, max_bytes=GLYPH_CACHE_MAX_BYTES):
+        self.font = font
+        self.height = font.height()
+        # glyph bitmap layout, chosen as CWriter does
+        if font.hmap():
+            self.map = framebuf.MONO_HMSB if font.reverse() else framebuf.MONO_HLSB
+        else:
+            self.map = framebuf.MONO_VLSB
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # text : (FrameBuffer, width, nbytes)
+
+    def _store(self, text, buf, width):
+        nbytes = len(buf)
+        while self._entries and self.size + nbytes > self.max_bytes:
+            old = next(iter(self._entries))
+            self.size -= self._entries.pop(old)[2]
+        entry = (framebuf.FrameBuffer(buf, width, self.height, self.map), width, nbytes)
+        self._entries[text] = entry
+        self.size += nbytes
+        return entry
+
+    def _buffer_size(self, width):
+        if self.map == framebuf.MONO_VLSB:
+            return ((self.height + 7) // 8) * width
+        return ((width + 7) // 8) * self.height
+
+    def _lookup(self, text):
+        entry = self._entries.pop(text, None)
+        if entry is not None:
+            self._entries[text] = entry  # most recently used
+            self.hits += 1
+        return entry
+
+    def glyph(self, ch):
+        entry = self._lookup(ch)
+        if entry is None:
+            self.misses += 1
+            glyph, height, width = self.font.get_ch(ch)
+            entry = self._store(ch, bytearray(glyph), width)
+        return entry
+
+    def preload(self, strings):
+        """ renders once each string of more than one char into a single bitmap,
+        single chars are loaded as glyphs"""
+        for text in strings:
+            if len(text) == 1:
+                self.glyph(text)
+            elif text not in self._entries:
+                width = self.width(text)
+                buf = bytearray(self._buffer_size(width))
+                fb = framebuf.FrameBuffer(buf, width, self.height, self.map)
+                col = 0
+                for ch in text:
+                    g = self.glyph(ch)
+                    fb.blit(g[0], col, 0)
+                    col += g[1]
+                self._store(text, buf, width)
+
+    def width(self, text):
+        entry = self._entries.get(text)
+        if entry is not None:
+            return entry[1]
+        w = 0
+        for ch in text:
+            w += self.glyph(ch)[1]
+        return w
+
+    def render(self, device, text, row, col, fgcolor, bgcolor):
+        palette = device.palette
+        palette.bg(bgcolor)
+        palette.fg(fgcolor)
+        entry = self._lookup(text)
+        if entry is not None:
+            device.blit(entry[0], col, row, -1, palette)
+            return
+        for ch in text:
+            fb, w, _ = self.glyph(ch)
+            device.blit(fb, col, row, -1, palette)
+            col += w
+
+    def __repr__(self):
+        return f"glyph cache: {len(self._entries)} entries | {self.size} bytes | hits {self.hits} | misses {self.misses}"
+
+
+class GlyphLabel(Label):
+    """ Label drawn from a GlyphCache instead of its CWriter"""
+    def __init__(self, writer, row, col, text, cache=None, **kwargs):
+        self.cache = get_glyph_cache(writer.font) if cache is None else cache
+        super().__init__(writer, row, col, text, **kwargs)
+
+    def show(self):
+        if Widget.show(self, False):  # Draw or erase border
+            txt = Widget.value(self)
+            if txt is None:  # created with a width, no content yet
+                return
+            ssd.fill_rect(self.col, self.row, self.width, self.height, self.bgcolor)
+            w = self.cache.width(txt)
+            col = self.col
+            if self.justify == Label.CENTRE:
+                col += (self.width - w) // 2
+            elif self.justify == Label.RIGHT:
+                col += self.width - w
+            self.cache.render(ssd, txt, self.row, col, self.fgcolor, self.bgcolor)
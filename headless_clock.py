@@ -0,0 +1,129 @@
+# xiansnn : headless time distribution, no display nor microGUI import
+#
+# Emits a time message aligned on each second (or RATE_HZ times per second)
+# over a UART or the USB serial, so that other equipment can slave to it.
+#
+# line format (NMEA like, XOR checksum of the characters between $ and *):
+#   $NTPCK,2026-10-19T12:34:56.000,2,NTP,1,12,3,45*5A
+#   fields: local date-time, time zone, selected source, validity,
+#           source error ms, source jitter ms, age of last sample s
+#
+# binary format (16 bytes, little endian):
+#   0xA5, 0x5A | seconds since 2000-01-01 local (I) | ms (H) | time zone (b)
+#   flags (B: bit 0 validity, bits 1-3 source index) | error ms (H) | jitter ms (H)
+#   age s (B) | checksum (B: XOR of bytes 2..14)
+
+import uasyncio as asyncio
+import struct, sys, time
+from machine import UART
+
+from lib_pico.NTP_device import *
+from lib_pico.local_clock import local_clock
+
+CET = const(1)
+CEST = const(2)
+UART_ID = 0                 # None : USB serial
+UART_BAUDRATE = const(115200)
+RATE_HZ = const(1)          # messages per second : 1, 2, 4, 5, 10
+BINARY_FORMAT = False
+SYNC_0 = const(0xA5)
+SYNC_1 = const(0x5A)
+ARBITER_PHASE_MS = const(500)   # next_second() runs mid-second, away from the emitted edges
+EPOCH_2000 = time.mktime((2000, 1, 1, 0, 0, 0, 0, 0))
+
+
+def nmea_checksum(payload):
+    cs = 0
+    for c in payload:
+        cs ^= c
+    return cs
+
+
+class TimeStreamer():
+    def __init__(self, ntp_device, uart=None, rate_hz=RATE_HZ, binary=BINARY_FORMAT):
+        self.ntp_device = ntp_device
+        self.uart = uart
+        self.rate_hz = rate_hz
+        self.period_ms = 1000 // rate_hz
+        self.binary = binary
+        self._frame = bytearray(16)
+        self._frame[0] = SYNC_0
+        self._frame[1] = SYNC_1
+        self.sent = 0
+        self._last_edge_ms = None
+
+    def _write(self, data):
+        if self.uart is None:
+            if isinstance(data, str):
+                sys.stdout.write(data)
+            else:
+                sys.stdout.buffer.write(data)
+        else:
+            self.uart.write(data)
+
+    def _quality(self):
+        arbiter = self.ntp_device.arbiter
+        source = arbiter.selected
+        age = source.age(arbiter.uptime)
+        age = 255 if age is None else min(age, 255)
+        return source, arbiter.sources.index(source), source.error_ms, source.jitter_ms(), age
+
+    def emit(self, now_ms):
+        sec, ms = divmod(now_ms, 1000)
+        # valid while a live source is selected and fresh, 0 in RTC holdover
+        valid = 1 if self.ntp_device.arbiter.is_synchronised() else 0
+        source, index, error, jitter, age = self._quality()
+        if self.binary:
+            f = self._frame
+            struct.pack_into("<IHbBHHB", f, 2, sec - EPOCH_2000, ms, self.ntp_device.time_zone,
+                             valid | (index << 1), min(abs(error), 0xFFFF), min(jitter, 0xFFFF), age)
+            cs = 0
+            for i in range(2, 15):
+                cs ^= f[i]
+            f[15] = cs
+            self._write(f)
+        else:
+            t = time.gmtime(sec)
+            payload = (f"NTPCK,{t[0]:4d}-{t[1]:02d}-{t[2]:02d}T{t[3]:02d}:{t[4]:02d}:{t[5]:02d}.{ms:03d},"
+                       f"{self.ntp_device.time_zone},{source.name},{valid},{error},{jitter},{age}")
+            self._write(f"${payload}*{nmea_checksum(payload.encode()):02X}\r\n")
+        self.sent += 1
+
+    async def run_arbiter(self):
+        """ source selection and slew, off the emit path"""
+        arbiter = self.ntp_device.arbiter
+        last_second = None
+        while True:
+            now_ms = arbiter.now_ms()
+            await asyncio.sleep_ms(1000 - (now_ms - ARBITER_PHASE_MS) % 1000)
+            second = (arbiter.now_ms() - ARBITER_PHASE_MS + 500) // 1000
+            if second == last_second:
+                continue  # woken early, same second
+            last_second = second
+            self.ntp_device.next_second()
+
+    async def run(self):
+        arbiter = self.ntp_device.arbiter
+        # the edges are placed on the sub-second local time
+        if not local_clock.is_anchored():
+            await local_clock.async_anchor()
+        asyncio.create_task(self.run_arbiter())
+        while True:
+            now_ms = arbiter.now_ms()
+            # sleep up to the next period edge, recomputed each time so that it does not drift
+            await asyncio.sleep_ms(self.period_ms - now_ms % self.period_ms)
+            now_ms = arbiter.now_ms()
+            edge_ms = (now_ms + self.period_ms // 2) // self.period_ms * self.period_ms
+            if edge_ms == self._last_edge_ms:
+                continue
+            self._last_edge_ms = edge_ms
+            self.emit(edge_ms)
+
+
+###############################################################################
+if __name__ == "__main__":
+    ntp_device = NTPdevice(time_zone=CEST)
+    ntp_device.start()
+    uart = None if UART_ID is None else UART(UART_ID, UART_BAUDRATE)
+    streamer = TimeStreamer(ntp_device, uart)
+    asyncio.run(streamer.run())
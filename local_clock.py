@@ -0,0 +1,98 @@
+# xiansnn : sub-second local time, anchored on ticks_us()
+#
+# On rp2, time.time_ns() is read from the RTC and only changes once per second.
+# LocalClock latches ticks_us() when the RTC second changes, then gives the local
+# time as that second plus the microseconds elapsed since, counted by ticks_us().
+# The anchor is moved forward on each read after REBASE_US, long before
+# ticks_diff() overflows (2**29 us, about 9 min): read it at least every few minutes.
+# Steps are applied to the anchor to the microsecond, the RTC is set to the second.
+#
+#     from lib_pico.local_clock import local_clock
+#     await local_clock.async_anchor()   # or local_clock.anchor(), blocks up to 1 s
+#     t_us = local_clock.time_us()
+
+import uasyncio as asyncio
+from utime import time, gmtime, ticks_us, ticks_diff, ticks_add
+from machine import RTC
+
+REBASE_US = const(60000000)   # the anchor is moved forward after 60 s
+EDGE_WINDOW_US = const(2000)  # async_anchor(): max time between the two RTC reads around the edge
+
+
+class LocalClock():
+    """ local time in microseconds since the epoch, RTC seconds and ticks_us() in between"""
+    def __init__(self):
+        self._anchor_us = None  # local time at self._ticks
+        self._ticks = 0
+        self.edge_error_us = 0  # uncertainty of the latched second edge
+
+    def is_anchored(self):
+        return self._anchor_us is not None
+
+    def _latch(self, sec, before, now):
+        # the RTC second changed between the ticks before and now : take the middle
+        window = ticks_diff(now, before)
+        self._ticks = ticks_add(now, -(window // 2))
+        self._anchor_us = sec * 10**6
+        self.edge_error_us = window // 2
+
+    def anchor(self):
+        """ waits for the next RTC second edge and latches it, blocks up to 1 s"""
+        sec = time()
+        before = ticks_us()
+        while True:
+            s = time()
+            now = ticks_us()
+            if s != sec:
+                self._latch(s, before, now)
+                return
+            before = now
+
+    async def async_anchor(self):
+        """ same as anchor(), yielding between the RTC reads. An edge seen after a longer
+        scheduling gap than EDGE_WINDOW_US is not latched, the next one is tried"""
+        sec = time()
+        before = ticks_us()
+        while True:
+            await asyncio.sleep_ms(0)
+            s = time()
+            now = ticks_us()
+            if s != sec:
+                if ticks_diff(now, before) <= EDGE_WINDOW_US:
+                    self._latch(s, before, now)
+                    return
+                sec = s
+            before = now
+
+    def time_us(self):
+        """ local time in us. Before the anchor is latched, the RTC time to the second"""
+        if self._anchor_us is None:
+            return time() * 10**6
+        now = ticks_us()
+        d = ticks_diff(now, self._ticks)
+        if d >= REBASE_US:
+            self._anchor_us += d
+            self._ticks = now
+            d = 0
+        return self._anchor_us + d
+
+    def step(self, us):
+        """ steps the local time by us and sets the RTC to the second.
+        Returns the step actually applied: rounded to the second while not anchored"""
+        if self._anchor_us is None:
+            us = (us + 500000) // 10**6 * 10**6
+            sec = time() + us // 10**6
+        else:
+            self._anchor_us += us
+            sec = self.time_us() // 10**6
+        tm = gmtime(sec)
+        RTC().datetime((tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5], 0))
+        return us
+
+    def __repr__(self):
+        if self._anchor_us is None:
+            return "local clock: not anchored, RTC seconds"
+        return f"local clock: anchored on the RTC second edge +/- {self.edge_error_us} us"
+
+
+local_clock = LocalClock()
@@ -0,0 +1,98 @@
+# xiansnn : scheduled garbage collection and heap telemetry
+#
+# MicroPython collects when an allocation fails or when the threshold is
+# reached, i.e. at any time, possibly in the middle of a render or an NTP
+# exchange. MemoryManager collects once per second, in the idle part of the
+# second after the render, and sets the threshold high enough so that the
+# automatic collection should not happen in between.
+# Free heap, largest free block and GC pause of each tick are kept in a ring.
+
+import gc
+from array import array
+import uasyncio as asyncio
+from time import ticks_us, ticks_diff
+
+GC_IDLE_DELAY_MS = const(600)     # delay after the second edge, once the screens are rendered
+MEM_HISTORY_DEPTH = const(60)     # ticks kept in the ring
+LARGEST_BLOCK_PERIOD = const(10)  # largest free block is probed every N ticks
+LARGEST_BLOCK_STEPS = const(8)
+
+
+class MemoryManager():
+    def __init__(self, threshold=None, depth=MEM_HISTORY_DEPTH, idle_delay_ms=GC_IDLE_DELAY_MS):
+        gc.collect()
+        if threshold is None:
+            threshold = gc.mem_free() // 4
+        gc.threshold(threshold)
+        self.threshold = threshold
+        self.idle_delay_ms = idle_delay_ms
+        self.depth = depth
+        self.free = array('L', [0] * depth)
+        self.largest = array('L', [0] * depth)
+        self.pause_us = array('L', [0] * depth)
+        self._head = 0
+        self.count = 0
+        self.ticks = 0
+        self.max_pause_us = 0
+        self._largest = 0
+        self.probe_us = 0   # last largest block probe, also counted in the pause of its tick
+
+    def largest_free_block(self):
+        """ coarse estimate : tries to allocate decreasing sizes, the first one that fits is kept.
+        Each failed allocation runs a full collection and the block that fits is far above
+        the threshold: only called by collect(), on the collected heap, which then
+        collects again to free the probe block."""
+        free = gc.mem_free()
+        step = free // LARGEST_BLOCK_STEPS
+        size = free
+        while size > 0:
+            try:
+                block = bytearray(size)
+                del block
+                return size
+            except MemoryError:
+                size -= step
+        return 0
+
+    def collect(self):
+        t0 = ticks_us()
+        gc.collect()
+        if self.ticks % LARGEST_BLOCK_PERIOD == 0:
+            # probed after the collection, the pause includes the probe and its hidden collections
+            t1 = ticks_us()
+            self._largest = self.largest_free_block()
+            gc.collect()  # frees the probe block before the allocation count triggers a collection
+            self.probe_us = ticks_diff(ticks_us(), t1)
+        pause = ticks_diff(ticks_us(), t0)
+        self.ticks += 1
+        i = self._head
+        self.free[i] = gc.mem_free()
+        self.largest[i] = self._largest
+        self.pause_us[i] = pause
+        self._head = (i + 1) % self.depth
+        if self.count < self.depth:
+            self.count += 1
+        if pause > self.max_pause_us:
+            self.max_pause_us = pause
+        return pause
+
+    def get(self, i):
+        """ (free, largest block, pause us), i = -1 is the newest tick"""
+        if i < 0:
+            i += self.count
+        j = (self._head - self.count + i) % self.depth
+        return self.free[j], self.largest[j], self.pause_us[j]
+
+    async def run(self, tick_event):
+        """ collects once per tick, idle_delay_ms after the tick event"""
+        while True:
+            await tick_event.wait()
+            await asyncio.sleep_ms(self.idle_delay_ms)
+            self.collect()
+
+    def __repr__(self):
+        if self.count == 0:
+            return "memory: no data"
+        free, largest, pause = self.get(-1)
+        return (f"memory: free {free} | largest {largest} | gc {pause} us (max {self.max_pause_us} us)"
+                f" | probe {self.probe_us} us")
@@ -0,0 +1,77 @@
+# xiansnn : screen instances and writers kept across Screen.change()
+#
+# Screen.change(cls) constructs a new screen on each call. A CachedScreen
+# subclass is built only once: the next Screen.change(cls) gets back the same
+# instance, with its widgets, writers and registered coroutines.
+# The coroutines are not recreated but suspended while the screen is hidden:
+#     async def periodic_task(self):
+#         while True:
+#             await self.wait_visible()
+#             ...
+# One-shot work (e.g. connect and poll) is restarted on each visit:
+#     async def on_each_open(self):
+#         while True:
+#             await self.wait_opened()
+#             ...
+
+from gui.core.ugui import Screen, ssd
+from gui.core.writer import CWriter
+import uasyncio as asyncio
+
+_writers = {}
+
+def get_writer(font, fgcolor, bgcolor):
+    """ CWriter shared by all screens for a given font and colors"""
+    key = (font, fgcolor, bgcolor)
+    wri = _writers.get(key)
+    if wri is None:
+        # verbose default indicates if fast rendering is enabled
+        wri = CWriter(ssd, font, fgcolor, bgcolor, verbose=False)
+        _writers[key] = wri
+    return wri
+
+
+def get_screen(cls):
+    """ the cached instance of cls, None if not built yet"""
+    return CachedScreen._instances.get(cls)
+
+
+class CachedScreen(Screen):
+    """ subclasses define build() instead of __init__()"""
+    _instances = {}
+
+    def __new__(cls, *args, **kwargs):
+        screen = CachedScreen._instances.get(cls)
+        if screen is None:
+            screen = super().__new__(cls)
+            screen._built = False
+            CachedScreen._instances[cls] = screen
+        return screen
+
+    def __init__(self, *args, **kwargs):
+        if self._built:
+            return
+        super().__init__()
+        self._built = True
+        self.visible = asyncio.Event()
+        self.opened = asyncio.Event()
+        self.build(*args, **kwargs)
+
+    def build(self):
+        pass
+
+    def after_open(self):
+        self.visible.set()
+        self.opened.set()
+
+    def on_hide(self):
+        self.visible.clear()
+
+    async def wait_visible(self):
+        if not self.visible.is_set():
+            await self.visible.wait()
+
+    async def wait_opened(self):
+        """ returns once per opening of the screen"""
+        await self.opened.wait()
+        self.opened.clear()
@@ -0,0 +1,154 @@
+# xiansnn : temperature and humidity history stored in packed arrays
+#
+# Three resolutions are kept in fixed-capacity rings:
+#   - the raw samples (one per DHT11 period)
+#   - min / max / mean per hour
+#   - min / max / mean per day
+# Values are stored in tenth of unit as signed 16 bits, time stamps as
+# 32 bits seconds. With the default capacities (2 hours of samples,
+# one week of hours, two months of days) the history needs about 5 kB.
+
+from array import array
+
+TEMPERATURE = const(0)
+HUMIDITY = const(1)
+# aggregate fields : min, max, mean for each measure
+T_MIN = const(0)
+T_MAX = const(1)
+T_MEAN = const(2)
+H_MIN = const(3)
+H_MAX = const(4)
+H_MEAN = const(5)
+
+
+class SampleRing():
+    """ fixed-capacity ring of time stamped records of nfields signed 16 bits values"""
+    def __init__(self, capacity, nfields):
+        self.capacity = capacity
+        self.nfields = nfields
+        self.time = array('L', [0] * capacity)
+        self.data = array('h', [0] * (capacity * nfields))
+        self._head = 0   # next write position
+        self.count = 0
+
+    def append(self, t, values):
+        i = self._head
+        self.time[i] = t
+        base = i * self.nfields
+        for f in range(self.nfields):
+            self.data[base + f] = values[f]
+        self._head = (i + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def _index(self, i):
+        """ i = 0 is the oldest record, negative i counts from the newest"""
+        if i < 0:
+            i += self.count
+        return (self._head - self.count + i) % self.capacity
+
+    def get_time(self, i):
+        return self.time[self._index(i)]
+
+    def get(self, i, field):
+        return self.data[self._index(i) * self.nfields + field]
+
+
+class Accumulator():
+    """ running min, max and mean of temperature and humidity"""
+    def __init__(self):
+        self._values = array('h', [0] * 6)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self._t_sum = 0
+        self._h_sum = 0
+
+    def add(self, t_value, h_value):
+        v = self._values
+        if self.count == 0:
+            v[T_MIN] = v[T_MAX] = t_value
+            v[H_MIN] = v[H_MAX] = h_value
+        else:
+            if t_value < v[T_MIN]: v[T_MIN] = t_value
+            if t_value > v[T_MAX]: v[T_MAX] = t_value
+            if h_value < v[H_MIN]: v[H_MIN] = h_value
+            if h_value > v[H_MAX]: v[H_MAX] = h_value
+        self.count += 1
+        self._t_sum += t_value
+        self._h_sum += h_value
+        v[T_MEAN] = self._t_sum // self.count
+        v[H_MEAN] = self._h_sum // self.count
+
+    def values(self):
+        return self._values
+
+
+class SensorHistory():
+    def __init__(self, samples=120, hours=168, days=62):
+        self.samples = SampleRing(samples, 2)
+        self.hours = SampleRing(hours, 6)
+        self.days = SampleRing(days, 6)
+        self.hour = Accumulator()
+        self.day = Accumulator()
+        self._hour_start = None
+        self._day_start = None
+        self._sample = array('h', [0, 0])
+
+    def add(self, t, temperature, humidity):
+        """ t in seconds, temperature in °C, humidity in %"""
+        t_value = int(round(temperature * 10))
+        h_value = int(round(humidity * 10))
+        hour_start = t - t % 3600
+        day_start = t - t % 86400
+        if self._hour_start is not None and hour_start != self._hour_start and self.hour.count:
+            self.hours.append(self._hour_start, self.hour.values())
+            self.hour.reset()
+        if self._day_start is not None and day_start != self._day_start and self.day.count:
+            self.days.append(self._day_start, self.day.values())
+            self.day.reset()
+        self._hour_start = hour_start
+        self._day_start = day_start
+        self._sample[TEMPERATURE] = t_value
+        self._sample[HUMIDITY] = h_value
+        self.samples.append(t, self._sample)
+        self.hour.add(t_value, h_value)
+        self.day.add(t_value, h_value)
+
+    def last(self):
+        """ (time, temperature, humidity) of the newest sample, None if empty"""
+        if self.samples.count == 0:
+            return None
+        return (self.samples.get_time(-1),
+                self.samples.get(-1, TEMPERATURE) / 10,
+                self.samples.get(-1, HUMIDITY) / 10)
+
+    def sparkline(self, device, x, y, width, height, color, measure=TEMPERATURE, ring=None):
+        """ draws the newest values of ring (default: raw samples), one per pixel column.
+        For the hour and day rings the mean is drawn. Cost is proportional to width."""
+        if ring is None:
+            ring, field = self.samples, measure
+        else:
+            field = T_MEAN if measure == TEMPERATURE else H_MEAN
+        n = min(width, ring.count)
+        if n == 0:
+            return
+        first = ring.count - n
+        lo = hi = ring.get(first, field)
+        for i in range(first + 1, ring.count):
+            v = ring.get(i, field)
+            if v < lo: lo = v
+            if v > hi: hi = v
+        span = max(hi - lo, 1)
+        x0 = x + width - n
+        prev = None
+        for c in range(n):
+            v = ring.get(first + c, field)
+            py = y + height - 1 - ((v - lo) * (height - 1)) // span
+            if prev is None:
+                device.pixel(x0 + c, py, color)
+            else:
+                device.line(x0 + c - 1, prev, x0 + c, py, color)
+            prev = py
+        return lo / 10, hi / 10
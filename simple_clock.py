@@ -1,13 +1,28 @@
-import hardware_setup
-from gui.core.ugui import Screen, ssd
-from gui.widgets import Label, LED, Dial, Pointer, Button, Textbox
-from gui.core.writer import CWriter
-# Font for CWriter
-import gui.fonts.arial10 as arial10
-import gui.fonts.arial35 as hours_font
-import gui.fonts.freesans20 as seconds_font
-import gui.fonts.freesans20 as date_font
-from gui.core.colors import *
+# staged startup : the clock is drawn from the RTC first,
+# DHT and NTP synchronisation are started in background once the first frame is shown
+from lib_pico.boot_stages import BootStages
+boot = BootStages()
+with boot.stage("display"):
+    import hardware_setup
+    from gui.core.ugui import Screen, ssd
+    from gui.widgets import Label, LED, Dial, Pointer, Button, Textbox
+    from lib_pico.screen_cache import CachedScreen, get_writer, get_screen
+    from lib_pico.glyph_cache import GlyphLabel, get_glyph_cache
+    from lib_pico.dirty_regions import DirtyRegions
+    from gui.core.colors import *
+
+# Font for CWriter, loaded when the first screen is built
+arial10 = hours_font = seconds_font = date_font = None
+
+def load_fonts():
+    global arial10, hours_font, seconds_font, date_font
+    if arial10 is not None:
+        return
+    with boot.stage("fonts"):
+        import gui.fonts.arial10 as arial10
+        import gui.fonts.arial35 as hours_font
+        import gui.fonts.freesans20 as seconds_font
+        import gui.fonts.freesans20 as date_font
 #------------------------------------------------------------------------------
 # Now import other modules
 from cmath import rect, pi
@@ -17,12 +32,12 @@ import time
 #------------------------------------------------------------------------------
 # DEBUG logic analyser probe definitions
 from debug_utility.pulses import *
-    # D0 = Probe(27) # wifi_connect & async_wifi_connect | DHT11 pulses train
+    # D0 = Probe(27) # wifi_connect & async_wifi_connect
     # D1 = Probe(16) # wifi_connect>loop & async get_connection_status
     # D2 = Probe(17) # 
     # D3 = Probe(18) # NTP_clock_screen.aclock_screen
     # D4 = Probe(19) # 
-    # D5 = Probe(20) # 
+    # D5 = Probe(20) # DirtyRegions.flush
     # D6 = Probe(21) # 
     # D7 = Probe(26) # one_second_time_trigger
 
@@ -47,26 +62,59 @@ async def one_second_coroutine():
         await asyncio.timer_elapsed.wait()
         D6.on()
         asyncio.timer_elapsed.clear()
-#         dcf_clock.next_second()
-
-asyncio.create_task(one_second_coroutine())
+        ntp_device.next_second()
 
 #------------------------------------------------------------------------------
 # import ntp modules
-from lib_pico.NTP_device import *
+with boot.stage("ntp device"):
+    from lib_pico.NTP_device import *
 CET = const(1)
 CEST = const(2)
 ntp_device = NTPdevice(time_zone=CEST)
+# sites with a DCF77 receiver : ntp_device.add_source(DCF77source(dcf_clock))
 
 #------------------------------------------------------------------------------
-# import and setup temperature and humidity device
-from lib_pico.dht_v2 import DHT11device
+# temperature and humidity pipeline, the sensor is started by start_dht() in background.
+# Screens subscribe to the pipeline instead of polling the sensor.
 DHT_PIN_IN = const(9)
 PERIOD = const(60)
-# active_clock = None
-dht11_device = DHT11device(DHT_PIN_IN, PERIOD)
-asyncio.create_task(dht11_device.async_measure())
-dht11_device.set_clock( ntp_device)
+from lib_pico.dht_pipeline import DHTpipeline
+dht_pipeline = DHTpipeline(PERIOD, clock=lambda: ntp_device.arbiter.now_ms() // 1000)
+
+from lib_pico.sensor_history import SensorHistory
+from lib_pico.text_log import TextLog, register_format
+dht_history = SensorHistory()
+dht_pipeline.subscribe(dht_history.add, every_sample=True)
+
+#------------------------------------------------------------------------------
+# background startup stages, run once the first frame is displayed
+def start_dht():
+    import dht
+    from machine import Pin
+    dht_pipeline.start(dht.DHT11(Pin(DHT_PIN_IN)), asyncio.timer_elapsed)
+
+def start_ntp():
+    # only the kickoff is timed by run_stages, the first NTP sample is tracked apart
+    ntp_device.start()  # NTP is polled by its own task
+    asyncio.create_task(one_second_coroutine())
+    boot.track("ntp synced", ntp_device.ntp_source.sampled.wait())
+
+from lib_pico.mem_manager import MemoryManager
+mem_manager = None
+
+def start_mem_manager():
+    global mem_manager
+    mem_manager = MemoryManager()
+    asyncio.create_task(mem_manager.run(asyncio.timer_elapsed))
+
+BACKGROUND_STAGES = (("dht", start_dht), ("ntp start", start_ntp), ("memory", start_mem_manager))
+
+async def background_boot():
+    await boot.run_stages(BACKGROUND_STAGES)
+    print(boot)
+    await boot.wait_tracked()
+    print(boot)
+
 #-------------------------- DCF77 GUI --------------------------------------
 # conversions table for Calendar
 days   = ('LUN', 'MAR', 'MER', 'JEU', 'VEN', 'SAM', 'DIM')
@@ -82,9 +130,9 @@ def fwdbutton(wri, row, col, cls_screen, text='Next'):
     
 
 #------------------------------------------------------------------------------
-class MainClockScreen(Screen):
-    def __init__(self):
-        super().__init__()
+class MainClockScreen(CachedScreen):
+    def build(self):
+        load_fonts()
         labels = {'bdcolor' : False,
                   'fgcolor' : YELLOW,
                   'bgcolor' : BLACK,
@@ -95,12 +143,12 @@ class MainClockScreen(Screen):
                   'bgcolor' : BLACK,
                   'justify' : Label.CENTRE,
           }
-        # verbose default indicates if fast rendering is enabled
-        wri         = CWriter(ssd, arial10, YELLOW, BLACK, verbose=False)  
-        wri_date    = CWriter(ssd, date_font, YELLOW, BLACK, verbose=False)  
-        wri_time    = CWriter(ssd, hours_font, YELLOW, BLACK, verbose=False)  
-        wri_seconds = CWriter(ssd, seconds_font, YELLOW, BLACK, verbose=False)  
-        wri_temp    = CWriter(ssd, seconds_font, YELLOW, BLACK, verbose=False)  
+        # writers are shared between screens, see screen_cache
+        wri         = get_writer(arial10, YELLOW, BLACK)
+        wri_date    = get_writer(date_font, YELLOW, BLACK)
+        wri_time    = get_writer(hours_font, YELLOW, BLACK)
+        wri_seconds = get_writer(seconds_font, YELLOW, BLACK)
+        wri_temp    = get_writer(seconds_font, YELLOW, BLACK)
         
         gap = 4  # Vertical gap between widgets
         
@@ -119,17 +167,36 @@ class MainClockScreen(Screen):
         self.lbl_hum_unit = Label(wri, row, col2, "%", **temp_colors)
         
         row = self.dial.mrow + gap
-        self.lbl_date = Label(wri_date, row, 2, 124, **labels)
+        # time, seconds and date are drawn from pre-rendered glyphs
+        get_glyph_cache(hours_font).preload("0123456789:")
+        get_glyph_cache(seconds_font).preload([f"{n:02d}" for n in range(60)])
+        self.lbl_date = GlyphLabel(wri_date, row, 2, 124, **labels)
         row = self.lbl_date.mrow + gap
-        self.lbl_tim = Label(wri_time, row, 2, '00:00', **labels)
+        self.lbl_tim = GlyphLabel(wri_time, row, 2, '00:00', **labels)
         self.led_status = LED(wri, row-gap, 105, height=10, bdcolor=False , fgcolor=False )
         row += 12
-        self.lbl_sec = Label(wri_seconds, row, 100, '00', **labels)
+        self.lbl_sec = GlyphLabel(wri_seconds, row, 100, '00', **labels)
                 
 
+        # only the bounding boxes of the changed widgets are sent to the display
+        self.dirty = DirtyRegions(ssd)
+
+        dht_pipeline.subscribe(self.on_dht_change)
         # setup async coroutines
         self.reg_task(self.periodic_clock_screen())
 
+    def on_dht_change(self, timestamp, temperature, humidity):
+        self.lbl_temperature.value(f"{temperature:3.1f}")
+        self.lbl_humidity.value(f"{humidity:3.1f}")
+
+    def after_open(self):
+        super().after_open()
+        self.dirty.take_refresh()
+
+    def on_hide(self):
+        super().on_hide()
+        self.dirty.release_refresh()
+
     async def periodic_clock_screen(self):
         def uv(phi):
             return rect(1, phi)
@@ -142,10 +209,7 @@ class MainClockScreen(Screen):
         sstart = 0 + 1j
     
         while True:
-            temperature  = dht11_device.get_temperature()
-            humidity = dht11_device.get_humidity()
-            self.lbl_temperature.value(f"{temperature:3.1f}")
-            self.lbl_humidity.value(f"{humidity:3.1f}")
+            await self.wait_visible()
             t = ntp_device.get_local_time()
             ## common_format : t[0]:year, t[1]:month, t[2]:mday, t[3]:hour, t[4]:minute, t[5]:second, t[6]:weekday, t[7]:time_zone, t[8]=time_validity
             hrs.value(hstart * uv(-t[3] * pi/6 - t[4] * pi / 360), CYAN)
@@ -158,64 +222,150 @@ class MainClockScreen(Screen):
             self.led_status.color(CYAN)
             if t[5]%2==0 : self.led_status(True)
             else: self.led_status(False)
+            self.dirty.mark_widget(self.dial)  # pointers are not tracked by the dial draw flag
+            D5.on()
+            await self.dirty.flush()
+            D5.off()
+            if boot.first_frame():
+                asyncio.create_task(background_boot())
             D3.off()
             await asyncio.timer_elapsed.wait()
             D3.on()
             asyncio.timer_elapsed.clear()            
             
 #------------------------------------------------------------------------------
-class DHT_data_screen(Screen):
-    def __init__(self):
-        super().__init__()
+# text log formats, the lines are formatted only when flushed to the Textbox
+DHT_SAMPLE = register_format("{:3.1f}C\t{:3.1f}%\t{:02d}:{:02d}")
+
+class DHT_data_screen(CachedScreen):
+    def build(self):
+        load_fonts()
         labels = {'bdcolor' : False,
                   'fgcolor' : YELLOW,
                   'bgcolor' : DARKBLUE,
                   'justify' : Label.CENTRE,
           }
 
-        wri = CWriter(ssd, arial10, YELLOW, BLACK, verbose=False)  # Report on fast mode. Or use verbose=False
-        wri_time = CWriter(ssd, seconds_font, YELLOW, BLACK, verbose=False)  # Report on fast mode. Or use verbose=False
+        wri = get_writer(arial10, YELLOW, BLACK)
+        wri_time = get_writer(seconds_font, YELLOW, BLACK)
         gap = 4  # Vertical gap between widgets
 
         self.lbl_title = Label(wri, 4, 2, 'data')
 
         fwdbutton(wri, 4, 45, MainClockScreen, text='clock')
-#         fwdbutton(wri, 4, 85, NTP_init_screen, text='wifi')
+        fwdbutton(wri, 4, 85, NTP_server_screen, text='ntp')
+        fwdbutton(wri, 4, 105, MemoryScreen, text='mem')
         
         row = 22
         self.lbl_date = Label(wri, row, 2, 120, **labels)
         row = self.lbl_date.mrow + gap
-        self.tb = Textbox(wri, row, 2, 120, 7, active=True)
-
+        self.tb = Textbox(wri, row, 2, 120, 4, active=True)
+        self.log = TextLog(ntrim=25)
+        # temperature sparkline of the last samples, drawn straight into the framebuffer
+        self.spark_row = self.tb.mrow + gap
+        self.spark_height = ssd.height - self.spark_row - 2
+
+        self.redraw_sparkline = True
+        dht_pipeline.subscribe(self.on_dht_sample, every_sample=True)
         self.reg_task(self.adetail_screen())
-        self.last_record = 0
+
+    def on_dht_sample(self, timestamp, temperature, humidity):
+        tm = time.gmtime(timestamp)
+        self.log.log(DHT_SAMPLE, temperature, humidity, tm[3], tm[4])
+        self.redraw_sparkline = True
+
+    def after_open(self):
+        super().after_open()
+        self.redraw_sparkline = True  # screen has been cleared
+
+    def draw_sparkline(self):
+        ssd.fill_rect(2, self.spark_row, 120, self.spark_height, BLACK)
+        dht_history.sparkline(ssd, 2, self.spark_row, 120, self.spark_height, GREEN)
+        self.redraw_sparkline = False
        
     async def adetail_screen(self):
         while True:
-#             t = time.gmtime()
+            await self.wait_visible()
             t = ntp_device.get_local_time()
 
             self.lbl_date.value(f"{t[0]:4d}-{t[1]:02d}-{t[2]:02d} {t[3]:02d}:{t[4]:02d}:{t[5]:02d}")
-            temperature  = dht11_device.get_temperature()
-            humidity = dht11_device.get_humidity()
-            if t[4]!=self.last_record:
-                self.tb.append(f"{temperature:3.1f}C\t{humidity:3.1f}%\t{t[3]:02d}:{t[4]:02d}", ntrim=25)
-                self.last_record = t[4]
+            self.log.flush(self.tb)
+            if self.redraw_sparkline:
+                self.draw_sparkline()
 
             await asyncio.timer_elapsed.wait()
             asyncio.timer_elapsed.clear()
 
-class NTP_server_screen(Screen):
-    def __init__(self):
-        super().__init__()
+#------------------------------------------------------------------------------
+class MemoryScreen(CachedScreen):
+    """ diagnostics : heap, GC pauses and display flush time"""
+    def build(self):
+        load_fonts()
+        labels = {'bdcolor' : False,
+                  'fgcolor' : YELLOW,
+                  'bgcolor' : DARKBLUE,
+                  'justify' : Label.LEFT,
+          }
+
+        wri = get_writer(arial10, YELLOW, BLACK)
+        gap = 4  # Vertical gap between widgets
+
+        self.lbl_title = Label(wri, 4, 2, 'memory')
+
+        fwdbutton(wri, 4, 45, MainClockScreen, text='clock')
+        fwdbutton(wri, 4, 85, DHT_data_screen, text='temp')
+
+        row = 22
+        self.lbl_free = Label(wri, row, 2, 120, **labels)
+        row = self.lbl_free.mrow + gap
+        self.lbl_block = Label(wri, row, 2, 120, **labels)
+        row = self.lbl_block.mrow + gap
+        self.lbl_gc = Label(wri, row, 2, 120, **labels)
+        row = self.lbl_gc.mrow + gap
+        self.lbl_threshold = Label(wri, row, 2, 120, **labels)
+        row = self.lbl_threshold.mrow + gap
+        self.lbl_flush = Label(wri, row, 2, 120, **labels)
+
+        self.reg_task(self.periodic_memory_screen())
+
+    async def periodic_memory_screen(self):
+        while True:
+            await self.wait_visible()
+            if mem_manager is not None and mem_manager.count:
+                free, largest, pause = mem_manager.get(-1)
+                self.lbl_free.value(f"free:  {free} B")
+                self.lbl_block.value(f"block: {largest} B")
+                self.lbl_gc.value(f"gc: {pause} us max {mem_manager.max_pause_us} us")
+                self.lbl_threshold.value(f"threshold: {mem_manager.threshold} B")
+            dirty = get_screen(MainClockScreen).dirty
+            if dirty.partial:
+                self.lbl_flush.value(f"flush: {dirty.last_flush_us} us max {dirty.max_flush_us} us")
+            else:
+                self.lbl_flush.value("flush: microGUI")
+
+            await asyncio.timer_elapsed.wait()
+            asyncio.timer_elapsed.clear()
+
+#------------------------------------------------------------------------------
+WLAN_RETRY = register_format("status[{}] #[{:02d}]")
+WLAN_STATUS = register_format("status[{}]")
+SERVER_HOST = register_format("{}")
+SERVER_ADDRESS = register_format("{}:{}")
+NTP_NO_REPLY = register_format("no NTP reply")
+NTP_OFFSET = register_format("offset {} ms")
+NTP_SAMPLE_WAIT = const(5)  # in seconds, for the first NTP sample
+
+class NTP_server_screen(CachedScreen):
+    def build(self):
+        load_fonts()
         labels = {'bdcolor' : False,
                   'fgcolor' : YELLOW,
                   'bgcolor' : DARKBLUE,
                   'justify' : Label.CENTRE,
           }
 
-        wri = CWriter(ssd, arial10, YELLOW, BLACK, verbose=False)  # Report on fast mode. Or use verbose=False
-        wri_time = CWriter(ssd, seconds_font, YELLOW, BLACK, verbose=False)  # Report on fast mode. Or use verbose=False
+        wri = get_writer(arial10, YELLOW, BLACK)
+        wri_time = get_writer(seconds_font, YELLOW, BLACK)
         gap = 4  # Vertical gap between widgets
 
         self.lbl_title = Label(wri, 4, 2, 'NTP')
@@ -227,39 +377,54 @@ class NTP_server_screen(Screen):
         self.lbl_date = Label(wri, row, 2, 120, **labels)
         row = self.lbl_date.mrow + gap
         self.tb = Textbox(wri, row, 2, 120, 7, active=True)
+        self.log = TextLog()
         
         from lib_pico.wifi_device import WiFiDevice
         self.wifi_device = WiFiDevice()
-        self.last_record = 0
         self.reg_task(self.periodic_ntp_screen())
+        self.reg_task(self.log.run(self.tb, asyncio.timer_elapsed, self.wait_visible))
 
        
     async def periodic_ntp_screen(self): 
-        self.wifi_device.wifi_connect()
-        D3.on()
-        max_wait = MAX_GET_STATUS_RETRY
-        while max_wait > 0:
-            D2.on()
-            status = self.wifi_device.get_status()
-            if status == network.STAT_CONNECTING:
-                self.tb.append(f"status[{status}] #[{max_wait:02d}]")
-                max_wait -= 1
+        # connect and poll again on each visit, the instance is cached
+        while True:
+            await self.wait_opened()
+            self.wifi_device.wifi_connect()
+            D3.on()
+            max_wait = MAX_GET_STATUS_RETRY
+            while max_wait > 0:
+                D2.on()
+                status = self.wifi_device.get_status()
+                if status == network.STAT_CONNECTING:
+                    self.log.log(WLAN_RETRY, status, max_wait)
+                    max_wait -= 1
+                    D2.off()
+                    await uasyncio.sleep(RETRY_GET_WLAN_CONNECT_STATUS)
+                else:
+                    self.log.log(WLAN_STATUS, status)
+                    D2.off()
+                    break
                 D2.off()
-                await uasyncio.sleep(RETRY_GET_WLAN_CONNECT_STATUS)
+            if max_wait == 0:
+                self.wifi_device.set_status(network.STAT_CONNECT_FAIL)
+            # the exchanges belong to the NTP source task : show its latest one, no poll of our own
+            source = ntp_device.ntp_source
+            try:
+                await asyncio.wait_for(source.sampled.wait(), NTP_SAMPLE_WAIT)
+            except asyncio.TimeoutError:
+                pass
+            t = ntp_device.get_local_time()
+            self.lbl_date.value(f"{t[0]:4d}-{t[1]:02d}-{t[2]:02d} {t[3]:02d}:{t[4]:02d}:{t[5]:02d}")
+            if source.frame is None:
+                self.log.log(NTP_NO_REPLY)
             else:
-                self.tb.append(f"status[{status}]")
-                D2.off()
-                break
-            D2.off()
-        if max_wait == 0:
-            self.wifi_device.set_status(network.STAT_CONNECT_FAIL)
-        ntp_time,frame,server = get_ntp_time(ntp_device.time_zone)
-        t = ntp_device.get_local_time()
-        self.lbl_date.value(f"{t[0]:4d}-{t[1]:02d}-{t[2]:02d} {t[3]:02d}:{t[4]:02d}:{t[5]:02d}")
-        self.tb.append(f"{server}")
-        await uasyncio.sleep(5)
-        Screen.change(MainClockScreen)
-        D3.off()
+                server = source.server
+                self.log.log(SERVER_HOST, server.host)
+                self.log.log(SERVER_ADDRESS, server.ip_address, server.ip_port)
+                self.log.log(NTP_OFFSET, source.offset_ms)
+            await uasyncio.sleep(5)
+            Screen.change(MainClockScreen)
+            D3.off()
 
         
 #         
@@ -276,8 +441,7 @@ class NTP_server_screen(Screen):
 #----------------- main program --------------------------
 
 if __name__ == "__main__":
-#     Screen.change(MainClockScreen)
-    Screen.change(NTP_server_screen)
+    Screen.change(MainClockScreen)
 
 
 
@@ -0,0 +1,94 @@
+# xiansnn : desktop python test setup
+#
+# The modules are written for MicroPython on the Pico. The tests run them on a
+# desktop python: the MicroPython only modules are replaced here by small fakes,
+# the clock ones driven by FakeClock so that the tests choose the time.
+#     python -m pytest tests
+
+import asyncio
+import builtins
+import calendar
+import os
+import sys
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TICKS_PERIOD = 1 << 30
+
+
+class FakeClock():
+    """ RTC with a 1 s resolution, like on rp2, and a ticks_us() counter on the same time base.
+    Every read advances the time by read_us."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self, us=1_000_000_000_250_000, read_us=10):
+        self.us = us            # ticks time base
+        self.rtc_offset_us = 0  # RTC - ticks time base, changed by a RTC write
+        self.read_us = read_us
+
+    def advance(self, us):
+        self.us += us
+
+    def _read(self):
+        self.us += self.read_us
+        return self.us
+
+    def time(self):
+        return (self._read() + self.rtc_offset_us) // 10**6
+
+    def time_ns(self):
+        return self.time() * 10**9  # the RTC seconds only
+
+    def ticks_us(self):
+        return self._read() % TICKS_PERIOD
+
+    def ticks_ms(self):
+        return (self._read() // 1000) % TICKS_PERIOD
+
+
+clock = FakeClock()
+
+
+def ticks_diff(a, b):
+    d = (a - b) % TICKS_PERIOD
+    return d - TICKS_PERIOD if d >= TICKS_PERIOD // 2 else d
+
+def ticks_add(a, d):
+    return (a + d) % TICKS_PERIOD
+
+
+class RTC():
+    def datetime(self, dt=None):
+        if dt is None:
+            tm = time.gmtime(clock.time())
+            return (tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5], 0)
+        # the RTC restarts its second on a write, ticks_us() goes on
+        sec = calendar.timegm((dt[0], dt[1], dt[2], dt[4], dt[5], dt[6]))
+        clock.rtc_offset_us = sec * 10**6 - clock.us
+
+
+def _module(name, **attributes):
+    m = types.ModuleType(name)
+    m.__dict__.update(attributes)
+    sys.modules[name] = m
+    return m
+
+
+builtins.const = lambda x: x
+_module("micropython", const=builtins.const, viper=lambda f: f, native=lambda f: f)
+builtins.ptr8 = builtins.ptr16 = builtins.ptr32 = object  # viper annotations
+_module("utime", time=clock.time, time_ns=clock.time_ns, gmtime=time.gmtime, mktime=time.mktime,
+        ticks_us=clock.ticks_us, ticks_ms=clock.ticks_ms, ticks_diff=ticks_diff, ticks_add=ticks_add)
+# modules importing the ticks from time instead of utime
+time.ticks_us, time.ticks_ms, time.ticks_diff, time.ticks_add = clock.ticks_us, clock.ticks_ms, ticks_diff, ticks_add
+asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+asyncio.wait_for_ms = lambda aw, ms: asyncio.wait_for(aw, ms / 1000)
+sys.modules["uasyncio"] = asyncio
+_module("machine", RTC=RTC, Timer=object, UART=object)
+_module("network", STA_IF=0)
+lib_pico = _module("lib_pico")
+lib_pico.__path__ = [ROOT]
+_module("lib_pico.wifi_device", WiFiDevice=object)  # not in this repository
+sys.path.insert(0, ROOT)
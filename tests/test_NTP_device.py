@@ -0,0 +1,39 @@
+from conftest import clock
+from lib_pico.local_clock import local_clock
+from lib_pico.NTP_device import TimeSource, TimeArbiter, RTCsource
+
+
+class FixedSource(TimeSource):
+    def __init__(self, offset_ms):
+        super().__init__("fixed", 1, 10)
+        self.offset = offset_ms
+
+    def poll(self):
+        return self.offset, 5
+
+    def shift(self, ms):
+        super().shift(ms)
+        self.offset -= ms
+
+
+def test_step_keeps_the_sub_second():
+    clock.reset()
+    local_clock.anchor()
+    source = FixedSource(12_345_678)
+    arbiter = TimeArbiter([source, RTCsource()])
+    t0 = arbiter.now_ms()
+    arbiter.next_second()
+    assert arbiter.correction_ms == 0
+    assert source.offset_ms == 0
+    assert abs(arbiter.now_ms() - t0 - 12_345_678) <= 1
+
+
+def test_step_before_the_anchor_is_rounded_to_the_second():
+    clock.reset()
+    local_clock._anchor_us = None
+    source = FixedSource(12_345_678)
+    arbiter = TimeArbiter([source, RTCsource()])
+    arbiter.next_second()
+    # the sources are shifted by the step applied, the remainder is slewed
+    assert source.offset_ms == 12_345_678 - 12_346_000
+    assert arbiter.correction_ms == -50
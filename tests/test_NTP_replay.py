@@ -0,0 +1,72 @@
+import struct
+
+from lib_pico.NTP_protocol import *
+from lib_pico.NTP_client import NTPcapture
+from lib_pico.NTP_replay import NTPreplay
+
+BASE = 3_900_000_000  # NTP seconds of the local time 0
+OFFSET_US = 7000      # server - local
+STEP_US = 3600 * 10**6
+SEND_TICKS = 1000
+DELAY_US = 2050
+
+
+def ts(us):
+    return ts_add_us(BASE, 0, us)
+
+def reply(origin, t2_us, t3_us):
+    msg = bytearray(DGRAM_SIZE)
+    msg[0] = (SNTP_VERSION << 3) | SERVER_MODE
+    msg[1] = 2
+    struct.pack_into("!IIIIII", msg, ORIGIN_OFFSET, *origin, *ts(t2_us), *ts(t3_us))
+    return bytes(msg)
+
+def exchange(capture, t1_us, origin, server_us, prev_server_tx_us=None):
+    """ one reply, the server clock being server_us at t1. Returns the server transmit time"""
+    t2 = server_us + 1000
+    t3 = t2 + 50
+    capture.append(reply(origin, t2, t3 if prev_server_tx_us is None else prev_server_tx_us),
+                   *ts(t1_us), SEND_TICKS, SEND_TICKS + DELAY_US)
+    return t3
+
+def replay(tmp_path, build):
+    capture = NTPcapture(str(tmp_path / "capture.bin"))
+    build(capture)
+    return NTPreplay(capture.filename).run()
+
+
+def test_forged_reply_keeps_the_previous_exchange(tmp_path):
+    def build(c):
+        tx = exchange(c, 0, ts(0), OFFSET_US)
+        exchange(c, 5 * 10**6, ts(123456), 0)  # origin matches nothing
+        exchange(c, 10 * 10**6, ts(DELAY_US), 10 * 10**6 + OFFSET_US, tx)
+    r = replay(tmp_path, build)
+    assert (r.records, r.invalid, r.interleaved) == (3, 1, 1)
+    assert r.offset.n == 2
+    assert abs(r.offset.min - OFFSET_US * 1e-6) < 1e-6
+    assert abs(r.offset.max - OFFSET_US * 1e-6) < 1e-6
+
+
+def test_step_between_exchanges(tmp_path):
+    # local clock 1 h late, stepped between the exchanges
+    def build(c):
+        tx = exchange(c, 0, ts(0), OFFSET_US + STEP_US)
+        c.append_step(STEP_US, False)
+        # the query carries the previous local receive stamp, already stepped
+        exchange(c, 10 * 10**6 + STEP_US, ts(DELAY_US + STEP_US), 10 * 10**6 + OFFSET_US + STEP_US, tx)
+    r = replay(tmp_path, build)
+    assert (r.records, r.invalid, r.interleaved, r.steps) == (2, 0, 1, 1)
+    assert abs(r.offset.min - OFFSET_US * 1e-6) < 1e-6
+
+
+def test_step_during_an_exchange(tmp_path):
+    def build(c):
+        tx = exchange(c, 0, ts(0), OFFSET_US + STEP_US)
+        # stepped while waiting for the reply : the query was built before the step
+        c.append_step(STEP_US, True)
+        tx = exchange(c, 10 * 10**6, ts(DELAY_US), 10 * 10**6 + OFFSET_US + STEP_US, tx)
+        exchange(c, 20 * 10**6 + STEP_US, ts(10 * 10**6 + DELAY_US + STEP_US), 20 * 10**6 + OFFSET_US + STEP_US, tx)
+    r = replay(tmp_path, build)
+    assert (r.records, r.invalid, r.interleaved, r.steps) == (3, 0, 2, 1)
+    assert abs(r.offset_step.max) < 1e-6  # both interleaved offsets on the stepped scale
+    assert abs(r.offset.min - OFFSET_US * 1e-6) < 1e-6
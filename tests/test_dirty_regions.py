@@ -0,0 +1,83 @@
+import asyncio
+import sys
+import types
+
+# microGUI is not installed on the desktop : only what DirtyRegions uses
+class Screen():
+    rfsh_start = None
+    rfsh_done = None
+    current_screen = types.SimpleNamespace(displaylist=[])
+
+    @staticmethod
+    def show(forceall):
+        pass
+
+for name in ("gui", "gui.core"):
+    sys.modules.setdefault(name, types.ModuleType(name))
+sys.modules["gui.core.ugui"] = types.SimpleNamespace(Screen=Screen)
+
+from lib_pico.dirty_regions import DirtyRegions
+
+
+class Device():
+    """ display with a windowed write, checks the bus is not shared with a microGUI refresh"""
+    width = 128
+    height = 128
+
+    def __init__(self):
+        self.refreshing = False
+        self.rects = []
+
+    def show_rect(self, x, y, w, h):
+        assert not self.refreshing
+        self.rects.append((x, y, w, h))
+
+
+async def auto_refresh(device):
+    # same sequence as microGUI : wait for rfsh_start, refresh by chunks, set rfsh_done
+    while True:
+        await Screen.rfsh_start.wait()
+        device.refreshing = True
+        for chunk in range(8):
+            await asyncio.sleep(0)
+        device.refreshing = False
+        Screen.rfsh_done.set()
+        await asyncio.sleep(0)
+
+
+def test_flush_waits_for_the_running_refresh():
+    async def main():
+        Screen.rfsh_start = asyncio.Event()
+        Screen.rfsh_done = asyncio.Event()
+        Screen.rfsh_start.set()
+        device = Device()
+        dirty = DirtyRegions(device)
+        task = asyncio.create_task(auto_refresh(device))
+        for i in range(12):  # a refresh is done, the next one is running
+            await asyncio.sleep(0)
+        assert device.refreshing and Screen.rfsh_done.is_set()
+        dirty.take_refresh()
+        await dirty.flush()
+        assert device.rects == [(0, 0, 128, 128)]
+        dirty.mark(10, 10, 20, 20)
+        await dirty.flush()
+        assert device.rects[-1] == (10, 10, 20, 20)
+        dirty.release_refresh()
+        for i in range(4):
+            await asyncio.sleep(0)
+        assert device.refreshing
+        task.cancel()
+    asyncio.run(main())
+
+
+def test_flush_with_microgui_idle():
+    async def main():
+        Screen.rfsh_start = asyncio.Event()
+        Screen.rfsh_done = asyncio.Event()
+        Screen.rfsh_done.set()
+        device = Device()
+        dirty = DirtyRegions(device)
+        dirty.take_refresh()
+        await dirty.flush()  # no refresh running : after the timeout
+        assert device.rects == [(0, 0, 128, 128)]
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+import asyncio
+
+from conftest import clock
+from lib_pico.local_clock import LocalClock
+from lib_pico import NTP_client
+
+
+def test_sub_second_resolution():
+    clock.reset()
+    c = LocalClock()
+    c.anchor()
+    t0 = c.time_us()
+    clock.advance(250_000)
+    assert abs(c.time_us() - t0 - 250_000) < 100
+    assert abs(c.time_us() - clock.us) < 100  # the anchor is the RTC second edge
+
+
+def test_async_anchor():
+    clock.reset(read_us=300)
+    c = LocalClock()
+    asyncio.run(c.async_anchor())
+    assert c.is_anchored()
+    assert abs(c.time_us() - clock.us) <= c.edge_error_us + 600
+
+
+def test_rebase_before_ticks_wrap_around():
+    clock.reset()
+    c = LocalClock()
+    c.anchor()
+    for i in range(30):  # 30 min, ticks_us() wraps around every 18 min
+        clock.advance(60_000_000)
+        assert abs(c.time_us() - clock.us) < 100
+
+
+def test_step_keeps_the_sub_second():
+    clock.reset()
+    c = LocalClock()
+    c.anchor()
+    t0 = c.time_us()
+    assert c.step(1_234_567) == 1_234_567
+    assert abs(c.time_us() - t0 - 1_234_567) < 100
+
+
+def test_local_ntp_timestamp_fraction():
+    # fails with a time source of 1 s resolution: the fraction would be stuck at 0
+    clock.reset()
+    NTP_client.local_clock.anchor()
+    clock.advance(500_000)
+    sec, frac = NTP_client.local_ntp_timestamp()
+    assert abs(frac - (1 << 31)) < (1 << 32) // 10000
+    assert sec - NTP_client.NTP_DELTA == clock.us // 10**6
+
+
+def test_arbiter_now_ms():
+    # fails with a time source of 1 s resolution: the ms would be stuck at the second
+    from lib_pico.NTP_device import TimeArbiter, RTCsource
+    clock.reset()
+    NTP_client.local_clock.anchor()
+    arbiter = TimeArbiter([RTCsource()])
+    t0 = arbiter.now_ms()
+    clock.advance(300_000)
+    assert abs(arbiter.now_ms() - t0 - 300) <= 1
+    assert abs(arbiter.now_ms() - clock.us // 1000) <= 1
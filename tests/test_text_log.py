@@ -0,0 +1,37 @@
+from lib_pico.text_log import TextLog, register_format
+
+TEXT = register_format("{}")
+PAIR = register_format("{} {}")
+NUMBER = register_format("{:d}")
+
+
+def test_truncation_on_a_character_boundary():
+    log = TextLog()
+    log.log(TEXT, "é" * 200)  # 400 bytes, cut in the middle of a character at 253
+    line = log.lines()[0]
+    assert line == "é" * len(line)
+    assert 120 <= len(line) <= 127
+
+
+def test_bytes_not_utf8():
+    log = TextLog()
+    log.log(TEXT, b"\xff\xfe")
+    log.log(TEXT, "next")
+    lines = log.lines()
+    assert lines[0].startswith(f"log #{TEXT}:")
+    assert lines[1] == "next"
+
+
+def test_ints_out_of_int32():
+    log = TextLog()
+    log.log(PAIR, 2**40, -2**35)
+    log.log(NUMBER, 1700000000123)
+    log.log(PAIR, 2**31 - 1, -2**31)
+    assert log.lines() == [f"{2**40} {-2**35}", "1700000000123", f"{2**31 - 1} {-2**31}"]
+
+
+def test_long_int_kept_whole_when_the_record_is_full():
+    log = TextLog()
+    log.log(PAIR, "x" * 300, 10**20)
+    line = log.lines()[0]
+    assert line.endswith(" " + str(10**20))
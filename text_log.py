@@ -0,0 +1,196 @@
+# xiansnn : coalesced text log for the Textbox diagnostic screens
+#
+# log(fmt_id, *args) only packs the format id and the arguments into a
+# fixed-size byte ring, no text is formatted on the logging path.
+# The records are formatted when displayed: flush(textbox) appends all the
+# pending lines in a single Textbox.append, so the textbox is redrawn at most
+# once per tick whatever the number of records logged in between.
+#
+# formats are registered once, at module level:
+#     STATUS = register_format("status[{}] #[{:02d}]")
+#     WLAN = register_format(explain_wlan_status)   # a callable works too
+#     log.log(STATUS, status, retry)
+#
+# record : fmt_id (B) | payload length (B) | arguments, each one tagged
+#     'i' + int32, 'f' + float32, 's' + length (B) + utf-8 bytes,
+#     'l' + length (B) + decimal digits for the ints out of the int32 range
+# A record holds at most 255 bytes of arguments: strings are truncated to fit,
+# on a character boundary, the arguments themselves are always all kept.
+# When the ring is full, the oldest records are dropped and counted.
+
+import struct
+import uasyncio as asyncio
+
+TEXT_LOG_SIZE = const(512)
+TEXT_LOG_PHASE_MS = const(100)  # after the second edge render, the tick event is cleared by then
+RECORD_MAX_SIZE = const(257)   # 2 bytes header + 255 bytes payload
+TAG_INT = const(0x69)          # 'i'
+TAG_FLOAT = const(0x66)        # 'f'
+TAG_STR = const(0x73)          # 's'
+TAG_LONG = const(0x6C)         # 'l'
+
+FORMATS = []
+
+def _is_int32(a):
+    return isinstance(a, int) and -0x80000000 <= a <= 0x7FFFFFFF
+
+def _min_size(a):
+    """ packed size of an argument, strings counted empty, long ints are never truncated"""
+    if _is_int32(a) or isinstance(a, float):
+        return 5
+    if isinstance(a, int):
+        return 2 + len(str(a))
+    return 2
+
+def register_format(fmt):
+    """ fmt : str.format() template or callable(*args) returning the text. Returns the format id"""
+    FORMATS.append(fmt)
+    return len(FORMATS) - 1
+
+
+class TextLog():
+    def __init__(self, size=TEXT_LOG_SIZE, ntrim=None):
+        self.size = size
+        self.ntrim = ntrim          # passed to Textbox.append
+        self._ring = bytearray(size)
+        self._record = bytearray(RECORD_MAX_SIZE)
+        self._head = 0              # oldest record
+        self._tail = 0              # next write
+        self.used = 0
+        self.pending = 0
+        self.logged = 0
+        self.dropped = 0
+        self.flushes = 0
+
+    def _pack(self, fmt_id, args):
+        """ every argument is kept, only string bytes are truncated when the record is full"""
+        r = self._record
+        limit = min(RECORD_MAX_SIZE, self.size)   # a record always fits in the ring
+        # room needed by the arguments still to pack, strings counted empty
+        reserve = 0
+        for a in args:
+            reserve += _min_size(a)
+        if 2 + reserve > limit:
+            args = ()  # too many arguments, formatted as a fallback line
+        n = 2
+        for a in args:
+            if _is_int32(a):
+                r[n] = TAG_INT
+                struct.pack_into("<i", r, n + 1, a)
+                n += 5
+                reserve -= 5
+            elif isinstance(a, float):
+                r[n] = TAG_FLOAT
+                struct.pack_into("<f", r, n + 1, a)
+                n += 5
+                reserve -= 5
+            elif isinstance(a, int):
+                b = str(a).encode()
+                length = len(b)
+                reserve -= 2 + length
+                r[n] = TAG_LONG
+                r[n + 1] = length
+                r[n + 2:n + 2 + length] = b
+                n += 2 + length
+            else:
+                reserve -= 2
+                b = a if isinstance(a, bytes) else str(a).encode()
+                length = min(len(b), limit - n - 2 - reserve)
+                while 0 < length < len(b) and b[length] & 0xC0 == 0x80:
+                    length -= 1  # do not cut a multi-byte character
+                r[n] = TAG_STR
+                r[n + 1] = length
+                r[n + 2:n + 2 + length] = b[:length]
+                n += 2 + length
+        r[0] = fmt_id
+        r[1] = n - 2
+        return n
+
+    def _drop_oldest(self):
+        length = self._ring[(self._head + 1) % self.size] + 2
+        self._head = (self._head + length) % self.size
+        self.used -= length
+        self.pending -= 1
+        self.dropped += 1
+
+    def log(self, fmt_id, *args):
+        n = self._pack(fmt_id, args)
+        while self.size - self.used < n:
+            self._drop_oldest()
+        # copy the record into the ring, in two parts when it wraps around
+        t = self._tail
+        first = min(n, self.size - t)
+        self._ring[t:t + first] = self._record[:first]
+        if first < n:
+            self._ring[:n - first] = self._record[first:n]
+        self._tail = (t + n) % self.size
+        self.used += n
+        self.pending += 1
+        self.logged += 1
+
+    def _read(self):
+        """ copies the oldest record out of the ring, returns its size"""
+        h = self._head
+        n = self._ring[(h + 1) % self.size] + 2
+        first = min(n, self.size - h)
+        self._record[:first] = self._ring[h:h + first]
+        if first < n:
+            self._record[first:n] = self._ring[:n - first]
+        self._head = (h + n) % self.size
+        self.used -= n
+        self.pending -= 1
+        return n
+
+    def _format(self, n):
+        r = self._record
+        args = []
+        i = 2
+        fmt = FORMATS[r[0]]
+        try:  # a bad record must not stop the flush task
+            while i < n:
+                tag = r[i]
+                if tag == TAG_INT:
+                    args.append(struct.unpack_from("<i", r, i + 1)[0])
+                    i += 5
+                elif tag == TAG_FLOAT:
+                    args.append(struct.unpack_from("<f", r, i + 1)[0])
+                    i += 5
+                else:
+                    length = r[i + 1]
+                    # bytes arguments are logged as is, they may not be utf-8
+                    text = str(bytes(r[i + 2:i + 2 + length]), "utf-8")
+                    args.append(int(text) if tag == TAG_LONG else text)
+                    i += 2 + length
+            if isinstance(fmt, str):
+                return fmt.format(*args)
+            return fmt(*args)
+        except Exception:
+            return f"log #{r[0]}: {args}"
+
+    def lines(self):
+        """ formats and removes the pending records"""
+        lines = []
+        while self.pending > 0:
+            lines.append(self._format(self._read()))
+        return lines
+
+    def flush(self, textbox):
+        """ appends all the pending records to the textbox in one call. Returns True if any"""
+        if self.pending == 0:
+            return False
+        textbox.append("\n".join(self.lines()), ntrim=self.ntrim)
+        self.flushes += 1
+        return True
+
+    async def run(self, textbox, tick_event, wait_visible=None):
+        """ flushes once per tick, only while the screen is visible if wait_visible is given"""
+        while True:
+            if wait_visible is not None:
+                await wait_visible()
+            await tick_event.wait()
+            await asyncio.sleep_ms(TEXT_LOG_PHASE_MS)
+            self.flush(textbox)
+
+    def __repr__(self):
+        return (f"text log: {self.used}/{self.size} bytes | pending {self.pending} | logged {self.logged}"
+                f" | dropped {self.dropped} | flushes {self.flushes}")